@@ -2,18 +2,36 @@
 import os
 import re
 import json
+import math
+import time
 import uuid
+import socket
+import threading
+import warnings
+import contextvars
 import redis
+import click
 import sqlparse
+import hashlib
+import gzip
 from azure.ai.inference import ChatCompletionsClient
 from azure.ai.inference.models import SystemMessage, UserMessage
 from azure.core.credentials import AzureKeyCredential
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify
-from sqlalchemy import create_engine, text
-from sqlalchemy.exc import ProgrammingError, OperationalError
+from flask import Flask, Response, g, has_request_context, render_template, request, jsonify, stream_with_context
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import DBAPIError, ProgrammingError, OperationalError
+from sqlalchemy.pool import Pool
+from sqlparse import tokens as T
 import pandas as pd
+import numpy as np
 from decimal import Decimal
+from datetime import date, datetime, timedelta
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Gauge, Histogram, generate_latest, multiprocess
+from prometheus_client import Counter as PromCounter
 
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -23,21 +41,26 @@ from flask_limiter.util import get_remote_address
 load_dotenv()
 app = Flask(__name__)
 
+# One connection pool for the app and flask_limiter, so both share the same sockets.
+redis_pool = redis.ConnectionPool(
+    host=os.getenv('REDIS_HOST', 'localhost'),
+    port=int(os.getenv('REDIS_PORT', 6379)),
+    db=0,
+    decode_responses=True,
+    socket_timeout=5,  # 5 second timeout
+    max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+)
+
 limiter = Limiter(
     get_remote_address,
     app=app,
-    storage_uri=f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', 6379)}"
+    storage_uri=f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', 6379)}",
+    storage_options={"connection_pool": redis_pool}
 )
 
 # Configure Redis with error handling
 try:
-    redis_client = redis.Redis(
-        host=os.getenv('REDIS_HOST', 'localhost'),
-        port=int(os.getenv('REDIS_PORT', 6379)),
-        db=0,
-        decode_responses=True,
-        socket_timeout=5  # 5 second timeout
-    )
+    redis_client = redis.Redis(connection_pool=redis_pool)
     redis_client.ping()
 except (redis.ConnectionError, redis.TimeoutError) as e:
     print(f"Warning: Redis connection failed: {e}")
@@ -67,57 +90,762 @@ Table: products, Columns: id (INT), name (VARCHAR), category (VARCHAR), price (D
 Table: sales, Columns: id (INT), customer_id (INT), product_id (INT), sale_date (DATE), quantity (INT)
 """
 
-# --- ROBUST CLASSIFICATION RULES using REGEX ---
-CLASSIFICATION_RULES = [
-    # 1. Greetings (only if it's JUST a greeting)
-    (re.compile(r"^\s*\b(hi|hello|hey|howdy|good (morning|afternoon|evening)|greetings)\b[\s.!?]*$", re.IGNORECASE),
-     "greeting",
-     "Hello! I'm InsightBot. Please ask a question about our sales data."),
-    
-    # 2. Farewells/Gratitude/Politeness
-    (re.compile(r"^\s*\b(bye|goodbye|see you|farewell|later|thanks|thank you|thx|kudos|appreciated|appreciate it|grateful)\b.*", re.IGNORECASE),
-     "gratitude",
-     "You're welcome! If you have more questions about sales data, just ask."),
-    
-    # 3. Security: SQL injection/dangerous patterns
-    (re.compile(r"(--|;|/\*|\*/| or 1=1|union select|information_schema)", re.IGNORECASE),
-     "invalid_operation",
-     "Your query contains potentially dangerous SQL patterns. Only safe, read-only queries are allowed."),
-    
-    # 4. Security: Forbidden SQL operations anywhere in the query
-    (re.compile(r"\b(delete|drop|update|insert|truncate|alter|grant|revoke|create|replace|exec|ddl|dml)\b", re.IGNORECASE),
-     "invalid_operation",
-     "For security reasons, I can only perform read-only (SELECT) queries. Commands like UPDATE, DELETE, etc., are not allowed."),
-    
-    # 5. Off-topic (expanded list)
-    (re.compile(r"\b(joke|weather|news|sports|movie|music|recipe|game|beyonce|elon musk|stock|bitcoin|ai|gpt|openai|fun fact|love|sing|story|capital of|who are you)\b", re.IGNORECASE),
-     "off_topic",
-     "I can only answer questions related to our sales, products, or customers."),
-    
-    # 6. Help/capabilities
-    (re.compile(r"^\s*\b(help|what can you do|capabilities|abilities)\b.*", re.IGNORECASE),
-     "help_request",
-     "I can answer questions about sales, products, and customers. Try asking something like: 'What are the top 5 selling products?' or 'Show me the total sales for last month'."),
-    
-    # 7. Empty or whitespace-only input
-    (re.compile(r"^\s*$", re.IGNORECASE),
-     "clarification_empty",
-     "Your query is empty. Please ask a question."),
-    
-    # 8. Vague/incomplete questions
-    (re.compile(r"^\s*\b(show me|what about|tell me|list|can you|info|information|details|more info|continue|next|previous)\b\s*$", re.IGNORECASE),
-     "clarification_vague",
-     "That's a bit vague. Can you be more specific? e.g., 'List the top 5 products by sales'."),
+# --- METRICS ---
+# Prometheus metrics, served on /metrics. Under gunicorn, PROMETHEUS_MULTIPROC_DIR makes
+# every worker write to shared files that /metrics aggregates (see gunicorn.conf.py).
+# Stage timings of the current request are also returned in a Server-Timing header.
+STAGE_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+STAGE_SECONDS = Histogram('insightbot_stage_seconds', 'Time spent in each stage of a request', ['stage'], buckets=STAGE_BUCKETS)
+REQUEST_SECONDS = Histogram('insightbot_request_seconds', 'End-to-end request time', ['endpoint', 'status'], buckets=STAGE_BUCKETS)
+PIPELINE_SECONDS = Histogram('insightbot_pipeline_seconds', 'Relevance check + SQL generation time on a cache miss', ['mode'], buckets=STAGE_BUCKETS)
+EVENTS = PromCounter('insightbot_events_total', 'Cache hits and misses and other pipeline events', ['event'])
+LLM_TOKENS = PromCounter('insightbot_llm_tokens_total', 'Model tokens used', ['call', 'kind'])
+SCHEMA_PROMPT_TOKENS = PromCounter('insightbot_schema_prompt_tokens_total', 'Schema tokens in prompts, full vs pruned', ['call', 'stage'])
+DB_POOL_WAIT_SECONDS = Histogram('insightbot_db_pool_wait_seconds', 'Time to check a connection out of the pool', buckets=STAGE_BUCKETS)
+DB_POOL_CHECKED_OUT = Gauge('insightbot_db_pool_checked_out', 'Database connections currently checked out', multiprocess_mode='livesum')
+
+event.listen(Pool, 'checkout', lambda *args: DB_POOL_CHECKED_OUT.inc())
+event.listen(Pool, 'checkin', lambda *args: DB_POOL_CHECKED_OUT.dec())
+
+# Stage timings of a request served outside Flask (asgi.py), which has no `g`.
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = g.get('timings') if has_request_context() else request_timings.get()
+    if timings is not None:
+        timings[stage] += seconds
+
+def server_timing(timings, total):
+    """The Server-Timing header for a request's stage timings and total time (seconds)."""
+    return ', '.join([f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()] + [f"total;dur={total * 1000:.1f}"])
+
+@contextmanager
+def timed(stage):
+    """Times a block, or a whole function when used as a decorator."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def record_llm_usage(call, response, seconds):
+    observe_stage(f"llm_{call}", seconds)
+    usage = getattr(response, 'usage', None)
+    if usage:
+        LLM_TOKENS.labels(call, 'prompt').inc(usage.prompt_tokens or 0)
+        LLM_TOKENS.labels(call, 'completion').inc(usage.completion_tokens or 0)
+
+def llm_complete(call, request_kwargs):
+    """client.complete() with its time and token usage recorded under `call`."""
+    start, response = time.perf_counter(), None
+    try:
+        response = client.complete(**request_kwargs)
+        return response
+    finally:
+        record_llm_usage(call, response, time.perf_counter() - start)
+
+def db_connect():
+    """engine.connect(), recording how long the pool checkout took."""
+    start = time.perf_counter()
+    connection = engine.connect()
+    wait = time.perf_counter() - start
+    DB_POOL_WAIT_SECONDS.observe(wait)
+    observe_stage('db_pool_wait', wait)
+    return connection
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.timings = defaultdict(float)
+
+@app.after_request
+def add_server_timing(response):
+    if 'request_start' not in g:  # rejected before start_request_timer ran
+        return response
+    total = time.perf_counter() - g.request_start
+    REQUEST_SECONDS.labels(request.endpoint or 'unknown', response.status_code).observe(total)
+    response.headers['Server-Timing'] = server_timing(g.timings, total)
+    return response
+
+# --- LOCAL (L1) CACHE ---
+# Each worker keeps the hottest decoded cache entries (answers, SQL, result sets, table
+# versions) in memory in front of Redis, for no longer than their remaining Redis TTL.
+# Every write is announced on CACHE_INVALIDATION_CHANNEL and the other workers drop their
+# copy. The L1 is only used while this worker is subscribed, so a lost subscription can't
+# leave it serving stale entries.
+L1_CACHE_SIZE = int(os.getenv('L1_CACHE_SIZE', 1024))  # 0 turns the L1 off
+L1_CACHE_TTL = int(os.getenv('L1_CACHE_TTL', 300))     # upper bound, in seconds
+L1_PREFIXES = ('relevance:', 'sql:', 'result:', 'table_version:', 'rollup:')
+CACHE_INVALIDATION_CHANNEL = 'cache:invalidate'
+MISSING = object()
+
+class LocalCache:
+    def __init__(self, size, ttl):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = size
+        self.ttl = ttl
+        self.enabled = False
+        self.generation = 0   # bumped by every invalidation
+        self.pid = None       # process the invalidation listener runs in
+
+    def get(self, key):
+        if not self.enabled: return MISSING
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return MISSING
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None, generation=None):
+        """Stores `value` for at most `ttl` seconds (its Redis TTL), unless an invalidation
+        arrived since `generation` was read, i.e. while the value was being fetched."""
+        if not self.enabled or not key.startswith(L1_PREFIXES): return
+        ttl = self.ttl if ttl is None or ttl < 0 else min(ttl, self.ttl)
+        with self.lock:
+            if generation is not None and generation != self.generation: return
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+local_cache = LocalCache(L1_CACHE_SIZE, L1_CACHE_TTL)
+local_cache_lock = threading.Lock()
+
+def invalidation_sender():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def invalidation_message(key):
+    return f"{invalidation_sender()} {key}"
+
+def listen_for_invalidations():
+    sender = invalidation_sender()
+    while True:
+        pubsub = None
+        try:
+            pubsub = redis_client.pubsub()
+            pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if not message: continue
+                if message['type'] == 'subscribe':
+                    local_cache.enabled = local_cache.size > 0
+                elif message['type'] == 'message':
+                    origin, key = message['data'].split(' ', 1)
+                    if origin != sender:
+                        local_cache.discard(key)
+                        wake_flight_waiter(key)
+        except Exception as e:
+            print(f"Cache invalidation listener error: {e}")
+            local_cache.enabled = False
+            local_cache.clear()
+            time.sleep(1)
+        finally:
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+def start_invalidation_listener():
+    """Starts this process's listener (once per gunicorn worker, not in the master)."""
+    if not redis_client or local_cache.pid == os.getpid(): return
+    with local_cache_lock:
+        if local_cache.pid == os.getpid(): return
+        local_cache.pid = os.getpid()
+        local_cache.enabled = False
+        local_cache.clear()
+        threading.Thread(target=listen_for_invalidations, name='cache-invalidation', daemon=True).start()
+
+# --- REQUEST-SCOPED REDIS ---
+# Within a request, Redis reads are gathered into as few pipelines as possible and
+# remembered, and writes are queued and sent in one pipeline after the view returns.
+# Outside a request (CLI, benchmarks, worker threads without a copied context) every
+# call goes straight to Redis.
+HISTORY_LENGTH = 5  # conversation turns kept and sent to the model
+
+class RequestRedis:
+    """A request's Redis reads and deferred writes. The request's threads (parallel
+    relevance/SQL calls, batch planners) share one, so its state is guarded by `lock`;
+    a round trip holds it, which only orders the threads' Redis calls."""
+    def __init__(self, client, deferred=True):
+        self.client = client
+        self.deferred = deferred
+        self.values = {}
+        self.fetched = {}   # key -> (remaining Redis TTL, L1 generation) for L1-cacheable keys
+        self.writes = []
+        self.round_trips = 0
+        self.lock = threading.RLock()
+
+    def execute(self, pipe):
+        with self.lock, timed('redis'):
+            self.round_trips += 1
+            return pipe.execute()
+
+    def read(self, keys, pipe=None, local=True):
+        """GETs every key not read yet (nor held in the L1 cache, unless `local` is False),
+        appended to `pipe` (which may already hold other commands) so it all goes in one round
+        trip. Returns the results of `pipe`'s own commands."""
+        pipe = pipe if pipe is not None else self.client.pipeline(transaction=False)
+        with self.lock:
+            missing = [key for key in dict.fromkeys(keys)
+                       if key not in self.values and not (local and local_cache.get(key) is not MISSING)]
+            cacheable = [key for key in missing if local_cache.enabled and key.startswith(L1_PREFIXES)]
+            for key in missing:
+                pipe.get(key)
+            for key in cacheable:
+                pipe.pttl(key)
+            generation = local_cache.generation
+            results = self.execute(pipe) if len(pipe) else []
+            own = len(results) - len(missing) - len(cacheable)
+            self.values.update(zip(missing, results[own:own + len(missing)]))
+            for key, ttl in zip(cacheable, results[own + len(missing):]):
+                self.fetched[key] = (ttl / 1000 if ttl > 0 else None, generation)
+            return results[:own]
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.values:
+                self.read([key], local=False)
+            return self.values[key]
+
+    def cached(self, key, decode, default=None):
+        """`key` decoded by `decode`, from the L1 cache or else from Redis (storing it in
+        the L1). Returns (value, tier) with tier 'l1', 'l2' or None for a missing key, which
+        is only cached (as `default`) when a default is given."""
+        value = local_cache.get(key)
+        if value is not MISSING:
+            return value, 'l1'
+        raw = self.get(key)
+        if raw is None and default is None:
+            return None, None
+        value = default if raw is None else decode(raw)
+        with self.lock:
+            ttl, generation = self.fetched.get(key, (None, -1))
+        local_cache.set(key, value, ttl, generation)
+        return value, 'l2'
+
+    def command(self, name, *args, **kwargs):
+        """Runs a read that cannot be batched (e.g. ZRANGEBYSCORE) right away."""
+        with self.lock, timed('redis'):
+            self.round_trips += 1
+            return getattr(self.client, name)(*args, **kwargs)
+
+    def queue(self, name, *args, **kwargs):
+        with self.lock:
+            self.writes.append((name, args, kwargs))
+            if not self.deferred:
+                self.flush()
+
+    def setex(self, key, ttl, value):
+        with self.lock:
+            self.values[key] = value
+            self.writes.append(('setex', (key, ttl, value), {}))
+            if key.startswith(L1_PREFIXES):  # announced right after the write, in the same pipeline
+                self.writes.append(('publish', (CACHE_INVALIDATION_CHANNEL, invalidation_message(key)), {}))
+            if not self.deferred:
+                self.flush()
+
+    def run(self, pipe):
+        """Executes `pipe` now, together with any queued writes, in one counted round trip.
+        Returns the results of `pipe`'s own commands."""
+        with self.lock:
+            own = len(pipe)
+            writes, self.writes = self.writes, []
+            for name, args, kwargs in writes:
+                getattr(pipe, name)(*args, **kwargs)
+            return self.execute(pipe)[:own]
+
+    def flush(self):
+        with self.lock:
+            if not self.writes: return
+            self.run(self.client.pipeline(transaction=False))
+
+def request_redis():
+    """The current request's RequestRedis (None without Redis)."""
+    if not redis_client: return None
+    if not has_request_context():
+        return RequestRedis(redis_client, deferred=False)
+    if 'redis' not in g:
+        start_invalidation_listener()
+        g.redis = RequestRedis(redis_client)
+    return g.redis
+
+@app.after_request
+def flush_request_redis(response):
+    layer = g.pop('redis', None)
+    if layer:
+        try:
+            layer.flush()
+        except redis.RedisError as e:
+            print(f"Cache error: {e}")
+        response.headers['X-Redis-Round-Trips'] = str(layer.round_trips)
+        record_stat('redis_requests')
+        record_stat('redis_round_trips', layer.round_trips)
+    return response
+
+# --- SINGLE-FLIGHT ---
+# When a shared link makes dozens of users ask the same uncached question at once, only one
+# of them calls the model or runs the query. Within a worker the others wait on the first
+# caller's Event; across workers the first to take a short Redis lock leads and writes its
+# answer to a result key announced on CACHE_INVALIDATION_CHANNEL. Followers that wait longer
+# than FLIGHT_WAIT_SECONDS, or whose leader failed, compute the answer themselves.
+FLIGHT_LOCK_SECONDS = int(os.getenv('FLIGHT_LOCK_SECONDS', 30))
+FLIGHT_WAIT_SECONDS = float(os.getenv('FLIGHT_WAIT_SECONDS', 15))
+FLIGHT_RESULT_TTL = 30
+FLIGHT_POLL_SECONDS = 0.5  # re-checks the result key in case a notification is missed
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = MISSING
+
+flights = {}
+flight_waiters = {}  # result key -> Event set when another worker announces it
+flights_lock = threading.Lock()
+
+def wake_flight_waiter(key):
+    event = flight_waiters.get(key)
+    if event:
+        event.set()
+
+def single_flight(key, compute, saves='llm_calls'):
+    """compute()'s value, computed once for every concurrent caller with the same `key`, in
+    this worker and (through Redis) in the others. The value must be JSON-serializable.
+    Each caller served by another's computation counts one `<saves>_saved`."""
+    with flights_lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = Flight()
+    if not leader:
+        finished = flight.done.wait(FLIGHT_WAIT_SECONDS)
+        if finished and flight.value is not MISSING:
+            record_stat('flight_follower')
+            record_stat(f"{saves}_saved")
+            return flight.value
+        record_stat('flight_leader_failed' if finished else 'flight_timeout')
+        return compute()
+    try:
+        flight.value = lead_flight(key, compute, saves)
+        return flight.value
+    finally:
+        with flights_lock:
+            flights.pop(key, None)
+        flight.done.set()
+
+def lead_flight(key, compute, saves):
+    """Runs compute() unless another worker holds the lock for `key`, in which case its value."""
+    if not redis_client:
+        return compute()
+    layer = request_redis()
+    lock_key, token = f"flight:lock:{key}", uuid.uuid4().hex
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.set(lock_key, token, nx=True, px=FLIGHT_LOCK_SECONDS * 1000)
+        pipe.get(lock_key)
+        acquired, holder = layer.run(pipe)
+    except redis.RedisError as e:
+        print(f"Cache error: {e}")
+        return compute()
+    if not acquired and holder:
+        entry = wait_for_flight(layer, f"flight:result:{key}:{holder}")
+        if entry and 'value' in entry:
+            record_stat('flight_follower')
+            record_stat(f"{saves}_saved")
+            return entry['value']
+        record_stat('flight_timeout' if entry is None else 'flight_leader_failed')
+        return compute()
+    record_stat('flight_leader')
+    entry = {"failed": True}
+    try:
+        entry = {"value": compute()}
+        return entry['value']
+    finally:
+        result_key = f"flight:result:{key}:{token}"
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.setex(result_key, FLIGHT_RESULT_TTL, json.dumps(entry, default=str))
+            pipe.publish(CACHE_INVALIDATION_CHANNEL, invalidation_message(result_key))
+            pipe.delete(lock_key)
+            layer.run(pipe)
+        except redis.RedisError as e:
+            print(f"Cache error: {e}")
+
+def wait_for_flight(layer, result_key):
+    """The leader's result entry, or None if it didn't arrive within FLIGHT_WAIT_SECONDS.
+    Each poll is a round trip on the request's RequestRedis `layer`."""
+    event = threading.Event()
+    with flights_lock:
+        flight_waiters[result_key] = event
+    deadline = time.monotonic() + FLIGHT_WAIT_SECONDS
+    try:
+        while True:
+            payload = layer.command('get', result_key)
+            if payload:
+                return json.loads(payload)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            event.wait(min(FLIGHT_POLL_SECONDS, remaining))
+            event.clear()
+    except redis.RedisError as e:
+        print(f"Cache error: {e}")
+        return None
+    finally:
+        with flights_lock:
+            flight_waiters.pop(result_key, None)
+
+# --- ROBUST CLASSIFICATION RULES ---
+# Rules live in classification_rules.json (override with CLASSIFICATION_RULES_FILE) and are
+# tried in file order; the first matching rule wins. A rule has either a regex "pattern"
+# or a list of "keywords" (whole words/phrases, case-insensitive), plus a status and message.
+# They are compiled into one matcher: every keyword goes into a single phrase table looked up
+# once per word of the question, and all patterns into one alternation with a named group
+# per rule, so classification does not loop over rules in Python. Keywords with punctuation
+# ("c++", ".net") are matched as patterns, and patterns that refer to their own groups
+# (backreferences, named groups) are tried on their own, since the alternation renumbers
+# groups and would clash on repeated names.
+CLASSIFICATION_RULES_FILE = os.getenv(
+    'CLASSIFICATION_RULES_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'classification_rules.json')
+)
+GROUP_REFERENCE = re.compile(r"(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\(|\(\?P=)")
+
+def keyword_pattern(keyword):
+    """A keyword as a case-insensitive pattern, matched as a whole word/phrase."""
+    return r"(?<!\w)" + r"\s+".join(re.escape(part) for part in keyword.lower().split()) + r"(?!\w)"
+
+class CompiledRules:
+    def __init__(self, rules):
+        self.rules = rules
+        self.phrases = {}
+        self.phrase_lengths = defaultdict(set)   # first word -> word counts of phrases starting with it
+        self.standalone = []                     # (index, compiled pattern), tried one by one
+        alternatives, gate = [], []
+        for index, rule in enumerate(rules):
+            pattern, ignore_case = rule.get('pattern'), rule.get('ignore_case', True)
+            symbols = []
+            for keyword in rule.get('keywords', ()):
+                if not re.fullmatch(r"\s*\w+(?:\s+\w+)*\s*", keyword):
+                    symbols.append(keyword_pattern(keyword))
+                    continue
+                words = keyword.lower().split()
+                self.phrases.setdefault(" ".join(words), index)
+                self.phrase_lengths[words[0]].add(len(words))
+            if symbols:
+                pattern, ignore_case = "|".join(symbols), True
+            if pattern is None:
+                continue
+            compiled = re.compile(pattern, re.IGNORECASE if ignore_case else 0)   # fails on a bad rule here, with its own pattern in the error
+            if compiled.groupindex or GROUP_REFERENCE.search(pattern):
+                self.standalone.append((index, compiled))
+                continue
+            flags = 'i' if ignore_case else '-i'
+            alternatives.append(f"(?{flags}:(?=[\\s\\S]*?(?:{pattern})))(?P<r{index}>)")
+            gate.append(f"(?{flags}:{pattern})")
+        # `gate` answers "does any pattern match?" in one scan; only then does the ordered
+        # lookahead alternation work out which rule matched first.
+        self.gate = re.compile("|".join(gate)) if gate else None
+        self.pattern = re.compile("|".join(alternatives)) if alternatives else None
+
+    def match(self, user_question):
+        """Returns the first rule (in file order) that matches, or None."""
+        best = len(self.rules)
+        if self.phrases:
+            words = re.findall(r"\w+", user_question.lower())
+            for start, word in enumerate(words):
+                for length in self.phrase_lengths.get(word, ()):
+                    index = self.phrases.get(" ".join(words[start:start + length]))
+                    if index is not None and index < best:
+                        best = index
+        if self.gate is not None and self.gate.search(user_question):
+            match = self.pattern.match(user_question)
+            if match and int(match.lastgroup[1:]) < best:
+                best = int(match.lastgroup[1:])
+        for index, pattern in self.standalone:
+            if index >= best:
+                break
+            if pattern.search(user_question):
+                best = index
+                break
+        return self.rules[best] if best < len(self.rules) else None
+
+def load_classification_rules(path=CLASSIFICATION_RULES_FILE):
+    with open(path) as f:
+        rules = json.load(f)
+    for rule in rules:
+        if not ('pattern' in rule) ^ ('keywords' in rule) or 'status' not in rule or 'message' not in rule:
+            raise ValueError(f"Invalid classification rule in {path}: {rule}")
+    return rules
+
+CLASSIFICATION_RULES = load_classification_rules()
+classifier = CompiledRules(CLASSIFICATION_RULES)
+
+# --- QUESTION CANONICALIZATION & NEAR-DUPLICATE CACHE ---
+# Paraphrases of an already answered question ("Top 5 products by sales?" vs
+# "show me the top five products by sales") are folded onto one cache key, and
+# close-enough canonical forms are matched with a char n-gram TF-IDF index. Answered
+# questions are shared between workers through a Redis sorted set scored by the time their
+# SQL was cached; both it and each worker's index keep the SIMILARITY_INDEX_MAX most recent
+# questions and drop those whose cached SQL (SQL_CACHE_TTL) has expired.
+SIMILARITY_THRESHOLD = float(os.getenv('SIMILARITY_THRESHOLD', 0.75))
+SIMILARITY_INDEX_KEY = 'sql_index:recent'
+SQL_CACHE_TTL = 3600
+SIMILARITY_INDEX_MAX = int(os.getenv('SIMILARITY_INDEX_MAX', 5000))
+SIMILARITY_SYNC_SECONDS = int(os.getenv('SIMILARITY_SYNC_SECONDS', 30))
+SIMILARITY_NGRAM = 3
+
+UNIT_WORDS = {
+    "zero": 0, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+    "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "thirteen": 13,
+    "fourteen": 14, "fifteen": 15, "sixteen": 16, "seventeen": 17, "eighteen": 18,
+    "nineteen": 19, "dozen": 12, "hundred": 100, "thousand": 1000,
+}
+TENS_WORDS = {
+    "twenty": 20, "thirty": 30, "forty": 40, "fifty": 50,
+    "sixty": 60, "seventy": 70, "eighty": 80, "ninety": 90,
+}
+
+DATE_PHRASES = [
+    (re.compile(r"\b(?:last|past|previous|prior)\s+(\d+)\s+(day|week|month|year)s?\b"), r"last_\1_\2s"),
+    (re.compile(r"\b(?:last|previous|prior|past)\s+(day|week|month|quarter|year)\b"), r"last_\1"),
+    (re.compile(r"\b(?:this|current)\s+(day|week|month|quarter|year)\b"), r"this_\1"),
+    (re.compile(r"\b(?:next|coming)\s+(day|week|month|quarter|year)\b"), r"next_\1"),
+    (re.compile(r"\b(?:year to date|ytd)\b"), "this_year"),
+    (re.compile(r"\b(?:monthly|per month|each month|by month)\b"), "per_month"),
+    (re.compile(r"\b(?:yearly|annually|annual|per year|each year|by year)\b"), "per_year"),
+    (re.compile(r"\b(?:daily|per day|each day|by day)\b"), "per_day"),
 ]
 
-def get_cache_key(user_question):
-    return f"query:{user_question.strip().lower()}"
+STOPWORDS = frozenset({
+    "a", "an", "the", "me", "us", "please", "show", "give", "list", "display", "get", "find",
+    "tell", "what", "which", "is", "are", "was", "were", "of", "for", "by", "in", "on", "to",
+    "can", "could", "would", "you", "i", "want", "see", "do", "does", "there", "my", "our",
+    "all", "just", "kindly", "about",
+})
+
+# Filler that can differ between two phrasings of the same question. A near-duplicate
+# match is only accepted when every other word (names, months, numbers, literals, ...)
+# agrees, in the same order and up to a plural "s": the n-gram score alone would happily
+# map "sales in May" onto "sales in March", "Alicia Johnson" onto "Alice Johnson" or
+# "sales from 2024 to 2023" onto "sales from 2023 to 2024". Only folded date phrases
+# ("per_month", "last_year") may move.
+FILLER_WORDS = frozenset({
+    "how", "many", "much", "did", "have", "has", "had", "we", "be", "been", "being",
+    "currently", "overall", "data", "info", "information", "report", "breakdown",
+    "according", "database", "here", "that", "this", "these", "those", "it", "its",
+})
+
+def _words_to_numbers(words):
+    result, i = [], 0
+    while i < len(words):
+        word = words[i]
+        if word in TENS_WORDS:
+            value = TENS_WORDS[word]
+            if i + 1 < len(words) and 0 < UNIT_WORDS.get(words[i + 1], 0) < 10:
+                value += UNIT_WORDS[words[i + 1]]
+                i += 1
+            word = str(value)
+        elif word in UNIT_WORDS:
+            word = str(UNIT_WORDS[word])
+        result.append(word)
+        i += 1
+    return result
+
+# Punctuation that changes what a question asks for: comparisons become words and decimal
+# numbers are kept whole, so "price > 100", "price < 100" and "price > 1.5" stay distinct.
+QUESTION_TOKEN = re.compile(r"\d+(?:\.\d+)+|[<>!]=|<>|[<>=]|\w+")
+OPERATOR_WORDS = {">=": "gte", "<=": "lte", "!=": "neq", "<>": "neq", ">": "gt", "<": "lt", "=": "eq"}
+
+def canonicalize_question(user_question):
+    """Reduces a question to a canonical form: no punctuation (comparison operators become
+    words), stopwords or number words, and common date phrases folded to single tokens
+    (e.g. 'previous month' -> 'last_month')."""
+    words = [OPERATOR_WORDS.get(token, token) for token in QUESTION_TOKEN.findall(user_question.lower())]
+    text_ = " ".join(_words_to_numbers(words))
+    for pattern, replacement in DATE_PHRASES:
+        text_ = pattern.sub(replacement, text_)
+    canonical = " ".join(word for word in text_.split() if word not in STOPWORDS)
+    return canonical or user_question.strip().lower()
+
+def _singular(word):
+    return word[:-3] + "y" if word.endswith("ies") else word.rstrip("s")
+
+DATE_TOKEN_PREFIXES = ('last_', 'this_', 'next_', 'per_')
+
+def _meaning_signature(canonical_question):
+    words = [_singular(word) for word in canonical_question.split() if word not in FILLER_WORDS]
+    return [w for w in words if not w.startswith(DATE_TOKEN_PREFIXES)], sorted(w for w in words if w.startswith(DATE_TOKEN_PREFIXES))
+
+def _char_ngrams(canonical_question):
+    padded = f" {canonical_question} "
+    return Counter(padded[i:i + SIMILARITY_NGRAM] for i in range(len(padded) - SIMILARITY_NGRAM + 1))
+
+class QuestionIndex:
+    """In-memory TF-IDF index of character n-grams over canonical questions whose SQL is cached."""
+
+    def __init__(self):
+        self.vectors = {}
+        self.postings = defaultdict(dict)
+        self.added = OrderedDict()   # question -> time its SQL was cached, oldest first
+        self.lock = threading.Lock()
+        self.last_sync = 0.0
+
+    def __contains__(self, question):
+        return question in self.vectors
+
+    def add(self, question, added=None):
+        """Indexes the question (again), evicting the oldest ones beyond SIMILARITY_INDEX_MAX."""
+        added = time.time() if added is None else added
+        with self.lock:
+            if question in self.vectors:
+                if added > self.added[question]:
+                    self.added[question] = added
+                    self.added.move_to_end(question)
+                return
+            vector = _char_ngrams(question)
+            self.vectors[question] = vector
+            self.added[question] = added
+            for gram, count in vector.items():
+                self.postings[gram][question] = count
+            while len(self.vectors) > SIMILARITY_INDEX_MAX:
+                self._remove(next(iter(self.added)))
+
+    def expire(self, before):
+        """Drops the questions added before `before` (their cached SQL has expired)."""
+        with self.lock:
+            while self.added and next(iter(self.added.values())) < before:
+                self._remove(next(iter(self.added)))
+
+    def remove(self, question):
+        with self.lock:
+            self._remove(question)
+
+    def _remove(self, question):
+        self.added.pop(question, None)
+        vector = self.vectors.pop(question, None)
+        for gram in vector or ():
+            self.postings[gram].pop(question, None)
+            if not self.postings[gram]:
+                del self.postings[gram]
+
+    def _idf(self, gram):
+        return math.log((1 + len(self.vectors)) / (1 + len(self.postings.get(gram, ())))) + 1
+
+    def best_match(self, question):
+        """Returns (question, cosine similarity) of the closest indexed question, or (None, 0.0)."""
+        query = _char_ngrams(question)
+        with self.lock:
+            weights = {gram: count * self._idf(gram) for gram, count in query.items()}
+            query_norm = math.sqrt(sum(w * w for w in weights.values()))
+            dots = defaultdict(float)
+            for gram, weight in weights.items():
+                for candidate, count in self.postings.get(gram, {}).items():
+                    dots[candidate] += weight * count * self._idf(gram)
+            best, best_score = None, 0.0
+            for candidate, dot in sorted(dots.items(), key=lambda item: item[1], reverse=True)[:5]:
+                norm = math.sqrt(sum((c * self._idf(g)) ** 2 for g, c in self.vectors[candidate].items()))
+                score = dot / (query_norm * norm) if query_norm and norm else 0.0
+                if score > best_score:
+                    best, best_score = candidate, score
+        return best, best_score
+
+question_index = QuestionIndex()
+
+# Per-worker counters, exposed on /stats.
+STATS = Counter()
+
+def record_stat(name, amount=1):
+    STATS[name] += amount
+    EVENTS.labels(name).inc(amount)
+
+def question_index_due():
+    """The score from which to pull questions into the local index, or None if it was
+    synced less than SIMILARITY_SYNC_SECONDS ago. Each pull re-reads one sync period to
+    allow for clock differences between workers."""
+    now = time.time()
+    if now - question_index.last_sync < SIMILARITY_SYNC_SECONDS:
+        return None
+    since, question_index.last_sync = question_index.last_sync - SIMILARITY_SYNC_SECONDS, now
+    return max(since, now - SQL_CACHE_TTL)
+
+def load_recent_questions(entries):
+    """Adds (question, time its SQL was cached) pairs read from SIMILARITY_INDEX_KEY and
+    forgets the questions whose cached SQL has expired."""
+    for question, added in entries:
+        question_index.add(question, added)
+    question_index.expire(time.time() - SQL_CACHE_TTL)
+
+def question_index_writes(canonical_question):
+    """The Redis commands that publish a question whose SQL was just cached, and trim
+    SIMILARITY_INDEX_KEY to the recent ones, as (name, args, kwargs)."""
+    now = time.time()
+    return [
+        ('zadd', (SIMILARITY_INDEX_KEY, {canonical_question: now}), {}),
+        ('zremrangebyscore', (SIMILARITY_INDEX_KEY, '-inf', now - SQL_CACHE_TTL), {}),
+        ('zremrangebyrank', (SIMILARITY_INDEX_KEY, 0, -SIMILARITY_INDEX_MAX - 1), {}),
+        ('expire', (SIMILARITY_INDEX_KEY, SQL_CACHE_TTL), {}),
+    ]
+
+def sync_question_index():
+    """Pulls questions answered by other workers from Redis into the local index."""
+    since = question_index_due() if redis_client else None
+    if since is None:
+        return
+    try:
+        load_recent_questions(request_redis().command('zrangebyscore', SIMILARITY_INDEX_KEY, since, '+inf', withscores=True))
+    except Exception as e:
+        print(f"Cache error: {e}")
+
+def remember_question(canonical_question):
+    question_index.add(canonical_question)
+    if not redis_client: return
+    layer = request_redis()
+    for name, args, kwargs in question_index_writes(canonical_question):
+        layer.queue(name, *args, **kwargs)
+
+@timed('similarity')
+def find_cache_question(user_question):
+    """Returns the canonical question whose cached `relevance:`/`sql:` entries should serve
+    this question: its own canonical form, or a near-duplicate that was already answered."""
+    sync_question_index()
+    return match_cache_question(user_question)
+
+def match_cache_question(user_question):
+    """find_cache_question() against the local index only (no Redis sync)."""
+    canonical = canonicalize_question(user_question)
+    if canonical in question_index:
+        return canonical
+    match, score = question_index.best_match(canonical)
+    if match and score >= SIMILARITY_THRESHOLD and _meaning_signature(match) == _meaning_signature(canonical):
+        print(f"Near-duplicate cache match ({score:.2f}): '{canonical}' -> '{match}'")
+        record_stat('near_duplicate_hit')
+        return match
+    return canonical
+
+def get_cache_key(user_question, namespace="query"):
+    return f"{namespace}:{canonicalize_question(user_question)}"
 
 def get_cached_response(cache_key):
     if not redis_client: return None
     try:
-        cached_data = redis_client.get(cache_key)
-        if cached_data: return json.loads(cached_data)
+        value, tier = request_redis().cached(cache_key, json.loads)
+        record_stat(f"cache_{tier}_hit" if tier else 'cache_miss')
+        return value
     except Exception as e:
         print(f"Cache error: {e}")
     return None
@@ -125,34 +853,402 @@ def get_cached_response(cache_key):
 def cache_response(cache_key, response_data, ttl=3600):
     if not redis_client: return
     try:
-        redis_client.setex(cache_key, ttl, json.dumps(response_data, default=str))
+        payload = json.dumps(response_data, default=str)
+        request_redis().setex(cache_key, ttl, payload)
+        local_cache.set(cache_key, json.loads(payload), ttl)
     except Exception as e:
         print(f"Cache error: {e}")
 
+@timed('pre_filter')
 def pre_filter_question(user_question):
-    for pattern, status, message in CLASSIFICATION_RULES:
-        if pattern.search(user_question):
-            return {"status": status, "message": message}
+    rule = classifier.match(user_question)
+    if rule:
+        return {"status": rule['status'], "message": rule['message']}
     return None
 
-def is_query_relevant(user_question):
-    cache_key = f"relevance:{user_question.strip().lower()}"
+def build_relevance_prompt(user_question):
+    return f"""The user asked: "{user_question}"\nMy database is ONLY about sales, products, and customers.\nIs the question answerable using ONLY this data? Answer with a single word: YES or NO."""
+
+# Each *_request() returns the keyword arguments for one model completion, so the
+# sync client here and the async client in asgi.py send identical requests.
+def relevance_request(user_question):
+    return dict(
+        messages=[SystemMessage("You are a relevancy checker."), UserMessage(build_relevance_prompt(user_question))],
+        model=MODEL, temperature=0.0, max_tokens=5
+    )
+
+def is_query_relevant(user_question, cache_question=None):
+    cache_key = f"relevance:{cache_question or canonicalize_question(user_question)}"
     cached_result = get_cached_response(cache_key)
-    if cached_result is not None: return cached_result
-    prompt = f"""The user asked: "{user_question}"\nMy database is ONLY about sales, products, and customers.\nIs the question answerable using ONLY this data? Answer with a single word: YES or NO."""
+    if cached_result is not None:
+        record_stat('relevance_cache_hit')
+        return cached_result
+    record_stat('relevance_cache_miss')
+    return single_flight(cache_key, lambda: check_relevance(user_question, cache_key))
+
+def check_relevance(user_question, cache_key):
     try:
-        response = client.complete(
-            messages=[SystemMessage("You are a relevancy checker."), UserMessage(prompt)],
-            model=MODEL, temperature=0.0, max_tokens=5
-        )
+        response = llm_complete('relevance', relevance_request(user_question))
         answer = response.choices[0].message.content.strip().upper()
         result = "YES" in answer
         cache_response(cache_key, result)
         return result
     except Exception as e:
         print(f"Error in is_query_relevant: {e}")
-        return False
+        return None
+
+# --- SCHEMA CATALOG ---
+# The tables, columns, keys and indexes behind SQL validation and the schema text in
+# prompts. Read from INFORMATION_SCHEMA at startup and refreshed in the background every
+# SCHEMA_REFRESH_SECONDS; if the database can't be read, schema.sql (then DB_SCHEMA) is used.
+# Prompts only get the tables that rank as relevant to the question, plus the tables
+# their foreign keys connect them to.
+SCHEMA_FILE = os.getenv('SCHEMA_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql'))
+SCHEMA_REFRESH_SECONDS = int(os.getenv('SCHEMA_REFRESH_SECONDS', 600))
+PROMPT_MAX_TABLES = int(os.getenv('PROMPT_MAX_TABLES', 6))
+PROMPT_MAX_COLUMNS = int(os.getenv('PROMPT_MAX_COLUMNS', 15))  # wider tables keep only key and matching columns
+PROMPT_MIN_SCORE_RATIO = 0.25
+TABLE_CONSTRAINT_WORDS = ('primary', 'foreign', 'key', 'index', 'unique', 'constraint', 'check', 'fulltext')
+INTERNAL_TABLE_PREFIX = 'rollup_'  # summary tables the app maintains itself (see SALES ROLLUPS)
+
+# Question words that point at a table or column without naming it.
+SCHEMA_SYNONYMS = {
+    'revenue': ('price', 'quantity', 'sale'), 'spent': ('price', 'quantity', 'sale'), 'spend': ('price', 'quantity', 'sale'),
+    'purchase': ('sale',), 'bought': ('sale', 'quantity'), 'buy': ('sale',), 'order': ('sale',),
+    'sold': ('sale', 'quantity'), 'sell': ('sale',), 'item': ('product', 'quantity'), 'unit': ('quantity',),
+    'client': ('customer',), 'buyer': ('customer',), 'who': ('customer',),
+    'signed': ('signup',), 'joined': ('signup',), 'cost': ('price',), 'expensive': ('price',), 'cheap': ('price',),
+    'day': ('date',), 'week': ('date',), 'month': ('date',), 'year': ('date',), 'recent': ('date',),
+}
+
+def _schema_terms(text_):
+    """Lower-cased words of a question or identifier, with plurals folded."""
+    words = re.findall(r"[a-z0-9]+", text_.lower().replace('_', ' '))
+    return [word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word for word in words]
+
+class SchemaCatalog:
+    def __init__(self, columns, primary_keys=None, foreign_keys=None, indexes=None, comments=None, source=''):
+        self.columns = columns                      # {table: {column: TYPE}}
+        self.primary_keys = primary_keys or {}      # {table: [column]}
+        self.foreign_keys = foreign_keys or {}      # {table: [(column, ref_table, ref_column)]}
+        self.indexes = indexes or {}                # {table: {index: [column]}}
+        self.comments = comments or {}              # {table or table.column: comment}
+        self.source = source
+        self.loaded_at = time.time()
+        # Ranking weights: table-name words count triple, column names and comments once,
+        # each scaled by how rare the word is across tables (so "id" or "date" barely count).
+        self.terms = {}
+        for table, table_columns in columns.items():
+            weights = Counter()
+            for term in _schema_terms(table):
+                weights[term] = 3
+            for column in table_columns:
+                for term in _schema_terms(f"{column} {self.comments.get(f'{table}.{column}', '')}"):
+                    weights[term] = max(weights[term], 1)
+            for term in _schema_terms(self.comments.get(table, '')):
+                weights[term] = max(weights[term], 1)
+            self.terms[table] = weights
+        document_counts = Counter(term for weights in self.terms.values() for term in weights)
+        self.rarity = {term: math.log(1 + len(columns) / count) for term, count in document_counts.items()}
+        self.full_description = self.describe()
+        self.full_tokens = count_tokens(self.full_description)
+
+    def neighbours(self, tables):
+        """Tables one foreign key away from any of `tables`, in either direction."""
+        linked = set()
+        for table, keys in self.foreign_keys.items():
+            for _, ref_table, _ in keys:
+                if table in tables and ref_table in self.columns:
+                    linked.add(ref_table)
+                elif ref_table in tables:
+                    linked.add(table)
+        return linked - set(tables)
+
+    def select(self, question, tables=()):
+        """Returns (tables, question_terms) for a prompt: the PROMPT_MAX_TABLES best-ranked
+        tables for the question plus `tables`, and their foreign-key neighbours."""
+        question_terms = set()
+        for term in _schema_terms(question):
+            question_terms.add(term)
+            question_terms.update(SCHEMA_SYNONYMS.get(term, ()))
+        scores = {table: sum(weights[term] * self.rarity[term] for term in question_terms if term in weights)
+                  for table, weights in self.terms.items()}
+        best = max(scores.values(), default=0)
+        # Tables far below the best match only share incidental words with the question.
+        ranked = sorted((table for table in scores if scores[table] > 0 and scores[table] >= best * PROMPT_MIN_SCORE_RATIO),
+                        key=lambda table: -scores[table])
+        selected = list(dict.fromkeys(ranked[:PROMPT_MAX_TABLES] + [t for t in tables if t in self.columns]))
+        return selected + sorted(self.neighbours(selected)), question_terms
+
+    def describe(self, tables=None, question_terms=None):
+        lines = []
+        for table in tables or self.columns:
+            primary = self.primary_keys.get(table, [])
+            references = {column: f"{ref_table}.{ref_column}" for column, ref_table, ref_column in self.foreign_keys.get(table, [])}
+            columns = self.columns[table]
+            if question_terms is not None and len(columns) > PROMPT_MAX_COLUMNS:
+                columns = {c: t for c, t in columns.items()
+                           if c in primary or c in references or question_terms.intersection(_schema_terms(c))}
+            parts = []
+            for column, type_ in columns.items():
+                notes = [type_] + (["primary key"] if column in primary else []) + ([f"references {references[column]}"] if column in references else [])
+                parts.append(f"{column} ({', '.join(notes)})")
+            omitted = len(self.columns[table]) - len(columns)
+            line = f"Table: {table}, Columns: {', '.join(parts)}" + (f", ... ({omitted} more columns)" if omitted else "")
+            indexes = [f"{name} ({', '.join(cols)})" for name, cols in self.indexes.get(table, {}).items()]
+            if indexes:
+                line += f"; Indexes: {', '.join(indexes)}"
+            if self.comments.get(table):
+                line += f" -- {self.comments[table]}"
+            lines.append(line)
+        return "\n".join(lines)
+
+_token_encoding = None
+
+def count_tokens(text_):
+    """Model tokens in `text_` (tiktoken when installed, else about four characters per token)."""
+    global _token_encoding
+    if _token_encoding is None:
+        try:
+            import tiktoken
+            _token_encoding = tiktoken.get_encoding('o200k_base')
+        except Exception:
+            _token_encoding = False
+    return len(_token_encoding.encode(text_)) if _token_encoding else len(text_) // 4
 
+def introspect_schema():
+    """Reads the current database's tables, columns, keys and indexes (INFORMATION_SCHEMA
+    on MySQL, SQLAlchemy's inspector elsewhere)."""
+    columns, primary_keys, foreign_keys = defaultdict(dict), defaultdict(list), defaultdict(list)
+    indexes, comments = defaultdict(lambda: defaultdict(list)), {}
+    with engine.connect() as connection:
+        if engine.dialect.name == 'mysql':
+            for table, column, data_type, comment in connection.execute(text(
+                    "SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE, COLUMN_COMMENT FROM INFORMATION_SCHEMA.COLUMNS "
+                    "WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME, ORDINAL_POSITION")):
+                table, column = table.lower(), column.lower()
+                columns[table][column] = data_type.upper()
+                if comment:
+                    comments[f"{table}.{column}"] = comment
+            for table, comment in connection.execute(text(
+                    "SELECT TABLE_NAME, TABLE_COMMENT FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = DATABASE()")):
+                if comment and comment != 'VIEW':
+                    comments[table.lower()] = comment
+            for table, column, ref_table, ref_column in connection.execute(text(
+                    "SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME "
+                    "FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL "
+                    "ORDER BY TABLE_NAME, CONSTRAINT_NAME, ORDINAL_POSITION")):
+                foreign_keys[table.lower()].append((column.lower(), ref_table.lower(), ref_column.lower()))
+            for table, index, column in connection.execute(text(
+                    "SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.STATISTICS "
+                    "WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX")):
+                if index == 'PRIMARY':
+                    primary_keys[table.lower()].append(column.lower())
+                else:
+                    indexes[table.lower()][index].append(column.lower())
+        else:
+            inspector = inspect(connection)
+            for table in inspector.get_table_names():
+                key = table.lower()
+                columns[key] = {c['name'].lower(): str(c['type']).split('(')[0].upper() for c in inspector.get_columns(table)}
+                primary_keys[key] = [c.lower() for c in inspector.get_pk_constraint(table)['constrained_columns']]
+                for fk in inspector.get_foreign_keys(table):
+                    for column, ref_column in zip(fk['constrained_columns'], fk['referred_columns']):
+                        foreign_keys[key].append((column.lower(), fk['referred_table'].lower(), ref_column.lower()))
+                for index in inspector.get_indexes(table):
+                    indexes[key][index['name']] = [c.lower() for c in index['column_names'] if c]
+    columns = {table: table_columns for table, table_columns in columns.items() if not table.startswith(INTERNAL_TABLE_PREFIX)}
+    if not columns:
+        raise ValueError("the database has no tables")
+    primary_keys = {table: keys for table, keys in primary_keys.items() if table in columns}
+    indexes = {table: dict(table_indexes) for table, table_indexes in indexes.items() if table in columns}
+    return SchemaCatalog(columns, primary_keys, dict(foreign_keys), indexes, comments, source='database')
+
+def parse_schema_file():
+    """The catalog described by the CREATE TABLE statements in schema.sql, falling back to
+    the DB_SCHEMA description."""
+    columns, primary_keys, foreign_keys = {}, defaultdict(list), defaultdict(list)
+    try:
+        with open(SCHEMA_FILE) as f:
+            ddl = f.read()
+        for table, body in re.findall(r"CREATE TABLE (?:IF NOT EXISTS )?`?(\w+)`?\s*\((.*?)\);", ddl, re.DOTALL | re.IGNORECASE):
+            table = table.lower()
+            columns[table] = {}
+            for line in body.split('\n'):
+                match = re.match(r"\s*`?(\w+)`?\s+(\w+)", line)
+                if match and match.group(1).lower() not in TABLE_CONSTRAINT_WORDS:
+                    columns[table][match.group(1).lower()] = match.group(2).upper()
+                    if re.search(r"\bPRIMARY KEY\b", line, re.IGNORECASE):
+                        primary_keys[table].append(match.group(1).lower())
+                for column, ref_table, ref_column in re.findall(r"FOREIGN KEY\s*\(`?(\w+)`?\)\s*REFERENCES\s+`?(\w+)`?\s*\(`?(\w+)`?\)", line, re.IGNORECASE):
+                    foreign_keys[table].append((column.lower(), ref_table.lower(), ref_column.lower()))
+                for keys in re.findall(r"^\s*PRIMARY KEY\s*\((.*?)\)", line, re.IGNORECASE):
+                    primary_keys[table].extend(key.strip(' `').lower() for key in keys.split(','))
+    except OSError as e:
+        print(f"Warning: could not read {SCHEMA_FILE}: {e}")
+    if columns:
+        return SchemaCatalog(columns, dict(primary_keys), dict(foreign_keys), source='schema.sql')
+    for table, table_columns in re.findall(r"Table: (\w+), Columns: (.*)", DB_SCHEMA):
+        columns[table] = {name: type_ for name, type_ in re.findall(r"(\w+) \((\w+)\)", table_columns)}
+    return SchemaCatalog(columns, source='DB_SCHEMA')
+
+def load_schema_catalog():
+    try:
+        return introspect_schema()
+    except Exception as e:
+        print(f"Warning: could not read the schema from the database, using {SCHEMA_FILE}: {e}")
+        return parse_schema_file()
+
+SCHEMA_CATALOG = load_schema_catalog()
+schema_refresh_lock = threading.Lock()
+
+def schema_catalog():
+    """The current catalog. Once it is SCHEMA_REFRESH_SECONDS old, a background thread
+    re-reads it; callers never wait for that."""
+    if time.time() - SCHEMA_CATALOG.loaded_at >= SCHEMA_REFRESH_SECONDS and schema_refresh_lock.acquire(blocking=False):
+        threading.Thread(target=refresh_schema_catalog, name='schema-refresh', daemon=True).start()
+    return SCHEMA_CATALOG
+
+def refresh_schema_catalog():
+    global SCHEMA_CATALOG
+    try:
+        catalog = introspect_schema()
+        if catalog.columns != SCHEMA_CATALOG.columns:
+            print(f"Schema changed: {len(SCHEMA_CATALOG.columns)} -> {len(catalog.columns)} tables")
+            validated_sql.clear()
+        SCHEMA_CATALOG = catalog
+    except Exception as e:
+        print(f"Warning: schema refresh failed, keeping the {SCHEMA_CATALOG.source} catalog: {e}")
+        SCHEMA_CATALOG.loaded_at = time.time()  # try again after another interval
+    finally:
+        schema_refresh_lock.release()
+
+def prompt_schema(call, question, tables=()):
+    """The schema text for a `call` prompt about `question`: the relevant tables (plus
+    `tables`) and their neighbours, or the whole schema when no table matches."""
+    catalog = schema_catalog()
+    selected, question_terms = catalog.select(question, tables)
+    description = catalog.describe(selected, question_terms) if selected else catalog.full_description
+    tokens = count_tokens(description)
+    SCHEMA_PROMPT_TOKENS.labels(call, 'full').inc(catalog.full_tokens)
+    SCHEMA_PROMPT_TOKENS.labels(call, 'pruned').inc(tokens)
+    print(f"Schema for {call} prompt: {catalog.full_tokens} -> {tokens} tokens ({len(selected) or len(catalog.columns)}/{len(catalog.columns)} tables)")
+    return description
+
+# --- OFFLINE SQL VALIDATION ---
+# Table and column references are checked against the schema catalog, so validation
+# costs no database round trip.
+# SQL_VALIDATION_MODE=server additionally runs EXPLAIN, on the same pooled
+# connection that then executes the query (see execute_sql).
+SQL_VALIDATION_MODE = os.getenv('SQL_VALIDATION_MODE', 'offline')
+if SQL_VALIDATION_MODE not in ('offline', 'server'):
+    raise ValueError("SQL_VALIDATION_MODE must be 'offline' or 'server'")
+VALIDATED_SQL_CACHE_SIZE = int(os.getenv('VALIDATED_SQL_CACHE_SIZE', 1024))
+
+validated_sql = OrderedDict()
+validated_sql_lock = threading.Lock()
+
+def is_validated(sql_query):
+    key = sql_fingerprint(sql_query)
+    with validated_sql_lock:
+        if key in validated_sql:
+            validated_sql.move_to_end(key)
+            return True
+    return False
+
+def mark_validated(sql_query):
+    with validated_sql_lock:
+        validated_sql[sql_fingerprint(sql_query)] = True
+        if len(validated_sql) > VALIDATED_SQL_CACHE_SIZE:
+            validated_sql.popitem(last=False)
+
+class InvalidSQL(ValueError):
+    """A statement the database would reject (a made-up table or column), found before it
+    ran. Like a ProgrammingError from the database, it is sent back to the model for
+    correction (see answer_steps); `errno` is the MySQL error the database would report."""
+    def __init__(self, sql_query, message, errno=None):
+        self.sql, self.errno = sql_query, errno
+        super().__init__(f"The generated SQL is invalid. Error: {message}")
+
+MYSQL_UNKNOWN_TABLE_ERRNO, MYSQL_UNKNOWN_COLUMN_ERRNO = 1146, 1054
+
+def check_sql_references(sql_string, catalog):
+    """Raises InvalidSQL when the statement reads a table missing from the catalog, or a
+    column that no referenced table, alias or CTE provides."""
+    tokens = [t for t in sqlparse.parse(sql_string)[0].flatten() if not t.is_whitespace and t.ttype not in T.Comment]
+    values = [t.value.upper() for t in tokens]
+
+    def is_name(i):
+        return 0 <= i < len(tokens) and tokens[i].ttype == T.Name and values[i + 1:i + 2] not in (['('], ['.'])
+
+    def name(i):
+        return tokens[i].value.strip('`').lower()
+
+    tables, aliases, derived, column_aliases, consumed = set(), {}, set(), set(), set()
+    scopes = []                    # (paren kind, in_from) of the enclosing scopes
+    in_from = expect_table = False
+    for i, token in enumerate(tokens):
+        value = values[i]
+        if i in consumed:
+            continue
+        if value == '(':
+            nxt = values[i + 1] if i + 1 < len(tokens) else ''
+            is_call = i > 0 and (tokens[i - 1].ttype in T.Name or tokens[i - 1].ttype in T.Keyword)
+            scopes.append(('query' if nxt in ('SELECT', 'WITH') else 'func' if is_call else 'group', in_from))
+            in_from = expect_table = False
+        elif value == ')':
+            in_from = scopes.pop()[1] if scopes else False
+            alias_at = i + 2 if values[i + 1:i + 2] == ['AS'] else i + 1
+            if is_name(alias_at):
+                (derived if in_from else column_aliases).add(name(alias_at))
+                consumed.add(alias_at)
+        elif token.ttype in T.Keyword:
+            if value == 'FROM' and not (scopes and scopes[-1][0] == 'func') or value.endswith('JOIN'):
+                in_from = expect_table = True
+            elif value != 'AS':
+                in_from = expect_table = False
+        elif value == ',':
+            expect_table = in_from
+        elif token.ttype == T.Name and values[i + 1:i + 3] == ['AS', '(']:
+            derived.add(name(i))   # WITH cte AS (...)
+        elif expect_table and token.ttype == T.Name:
+            end = i + 2 if values[i + 1:i + 2] == ['.'] and i + 2 < len(tokens) else i   # schema.table
+            consumed.update(range(i, end + 1))
+            table = name(end)
+            if table not in catalog and table not in derived:
+                raise InvalidSQL(sql_string, f"Table '{table}' doesn't exist", MYSQL_UNKNOWN_TABLE_ERRNO)
+            if table in catalog:
+                tables.add(table)
+                aliases[table] = table
+            alias_at = end + 2 if values[end + 1:end + 2] == ['AS'] else end + 1
+            if is_name(alias_at):
+                if table in catalog:
+                    aliases[name(alias_at)] = table
+                else:
+                    derived.add(name(alias_at))
+                consumed.add(alias_at)
+            expect_table = False
+        elif is_name(i) and i > 0 and values[i - 1] != '.' and (
+                values[i - 1] in ('AS', 'END') or tokens[i - 1].ttype == T.Name or tokens[i - 1].ttype in T.Literal):
+            column_aliases.add(name(i))   # `expr AS alias` / `expr alias`
+            consumed.add(i)
+
+    known_columns = set().union(*(catalog[t] for t in tables))
+    for i, token in enumerate(tokens):
+        if i in consumed or token.ttype != T.Name or values[i + 1:i + 2] in (['('], ['.']):
+            continue
+        column = name(i)
+        if values[i - 1:i] == ['.']:
+            qualifier = name(i - 2)
+            if qualifier in aliases and column not in catalog[aliases[qualifier]]:
+                raise InvalidSQL(sql_string, f"Unknown column '{qualifier}.{column}'", MYSQL_UNKNOWN_COLUMN_ERRNO)
+            if qualifier not in aliases and qualifier not in derived:
+                raise InvalidSQL(sql_string, f"Unknown column '{qualifier}.{column}'", MYSQL_UNKNOWN_COLUMN_ERRNO)
+        elif column not in known_columns and column not in column_aliases and column not in derived and column not in aliases:
+            raise InvalidSQL(sql_string, f"Unknown column '{column}'", MYSQL_UNKNOWN_COLUMN_ERRNO)
+
+@timed('validate')
 def clean_and_validate_sql(sql_string):
     """Cleans, secures, and validates the SQL query with the correct order of operations."""
     if "```" in sql_string:
@@ -177,47 +1273,200 @@ def clean_and_validate_sql(sql_string):
     if 'limit' not in sql_lower and not is_agg_without_group:
         sql_string += ' LIMIT 1000'
 
-    try:
-        with engine.connect() as connection:
-            with connection.begin():
-                connection.execute(text(f"EXPLAIN {sql_string}"))
-    except (ProgrammingError, OperationalError) as e:
-        raise ValueError(f"The generated SQL is invalid. Error: {e}")
-
+    if is_validated(sql_string):
+        return sql_string
+    check_sql_references(sql_string, schema_catalog().columns)
+    if SQL_VALIDATION_MODE == 'offline':
+        mark_validated(sql_string)
     return sql_string
 
-def generate_sql(user_question, conversation_history=None):
-    cache_key = f"sql:{user_question.strip().lower()}"
-    if not conversation_history:
-        cached_sql = get_cached_response(cache_key)
-        if cached_sql: return cached_sql
+@timed('explain')
+def explain_sql(connection, sql_query):
+    """EXPLAINs the query on the connection that will run it and returns the plan rows.
+    In server validation mode a failure is reported as invalid SQL; otherwise the
+    database error propagates as it would from execution (and can be self-healed)."""
+    try:
+        plan = connection.execute(text(f"EXPLAIN {sql_query}")).mappings().all()
+    except (ProgrammingError, OperationalError) as e:
+        if SQL_VALIDATION_MODE != 'server':
+            raise
+        raise InvalidSQL(sql_query, e, mysql_errno(e)) from e
+    mark_validated(sql_query)
+    return plan
 
-    system_prompt = "You are an expert SQL query generator."
-    
+def build_history_context(conversation_history):
     context_str = ""
     if conversation_history:
         context_str += "This is our conversation history (previous questions and the SQL I generated for them):\n"
         for entry in conversation_history:
             context_str += f"- User: \"{entry['user_question']}\"\n  AI_SQL: \"{entry['sql_query']}\"\n"
         context_str += "\nBased on this context, please answer the user's latest question. If their question is a follow-up, use the context to form the correct query. Otherwise, treat it as a new question.\n"
+    return context_str
+
+def sql_tables(*sql_queries):
+    """Catalog tables read by any of the statements (None and blanks skipped), so prompts
+    about earlier or failed SQL keep the tables it used."""
+    return [table for sql_query in sql_queries if sql_query and sql_query.strip() for table in referenced_tables(sql_query)]
+
+def history_tables(conversation_history):
+    return sql_tables(*(entry['sql_query'] for entry in conversation_history or []))
+
+def build_sql_prompt(user_question, conversation_history=None):
+    context_str = build_history_context(conversation_history)
+    schema = prompt_schema('sql', user_question, history_tables(conversation_history))
+    return f"{context_str}Given the MySQL schema:\n{schema}\n\nGenerate a single, valid MySQL SELECT query for the question: \"{user_question}\"\n\nOnly output the SQL query itself, with no additional text or formatting."
+
+def sql_request(user_question, conversation_history=None):
+    return dict(
+        messages=[SystemMessage("You are an expert SQL query generator."), UserMessage(build_sql_prompt(user_question, conversation_history))],
+        model=MODEL, temperature=0.0
+    )
+
+def store_generated_sql(cache_question, sql):
+    cache_response(f"sql:{cache_question}", sql, ttl=SQL_CACHE_TTL)
+    remember_question(cache_question)
 
-    prompt = f"{context_str}Given the MySQL schema:\n{DB_SCHEMA}\n\nGenerate a single, valid MySQL SELECT query for the question: \"{user_question}\"\n\nOnly output the SQL query itself, with no additional text or formatting."
+def generate_sql(user_question, conversation_history=None, cache_question=None, store=True):
+    """Returns SQL for the question. With store=False a freshly generated query is not
+    cached, for callers that may still discard it (see plan_query)."""
+    cache_question = cache_question or canonicalize_question(user_question)
+    cache_key = f"sql:{cache_question}"
+    if not conversation_history:
+        cached_sql = get_cached_response(cache_key)
+        if cached_sql:
+            record_stat('sql_cache_hit')
+            return cached_sql
+        record_stat('sql_cache_miss')
+        return single_flight(cache_key, lambda: write_sql(user_question, None, cache_question if store else None))
+    return write_sql(user_question, conversation_history)
 
+def write_sql(user_question, conversation_history=None, cache_question=None):
+    """Asks the model for SQL, caching it under `cache_question` if given."""
     try:
-        response = client.complete(
-            messages=[SystemMessage(system_prompt), UserMessage(prompt)],
-            model=MODEL, temperature=0.0
-        )
+        response = llm_complete('sql', sql_request(user_question, conversation_history))
         sql = response.choices[0].message.content
-        if not conversation_history:
-            cache_response(cache_key, sql)
+        if cache_question:
+            store_generated_sql(cache_question, sql)
         return sql
     except Exception as e:
         print(f"Error in generate_sql: {e}")
         return None
 
-def generate_corrected_sql(user_question, original_sql, error_message):
-    """Asks the AI to correct a faulty SQL query."""
+# --- RELEVANCE + SQL PIPELINE ---
+# sequential: relevance check, then SQL generation (two model round trips on a miss).
+# parallel:   both calls start together on a bounded pool; SQL is discarded on NO.
+# merged:     one completion returns the verdict and the SQL together.
+LLM_PIPELINE_MODE = os.getenv('LLM_PIPELINE_MODE', 'sequential')
+LLM_POOL_SIZE = int(os.getenv('LLM_POOL_SIZE', 8))
+PIPELINE_MODES = ('sequential', 'parallel', 'merged')
+if LLM_PIPELINE_MODE not in PIPELINE_MODES:
+    raise ValueError(f"LLM_PIPELINE_MODE must be one of {', '.join(PIPELINE_MODES)}")
+llm_executor = ThreadPoolExecutor(max_workers=LLM_POOL_SIZE, thread_name_prefix='llm')
+
+# Last 1000 samples per pipeline mode, in seconds, exposed as p50/p95 on /stats.
+LATENCIES = defaultdict(lambda: deque(maxlen=1000))
+
+def record_latency(name, seconds):
+    LATENCIES[name].append(seconds)
+    PIPELINE_SECONDS.labels(name).observe(seconds)
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def build_merged_prompt(user_question, conversation_history=None):
+    context_str = build_history_context(conversation_history)
+    schema = prompt_schema('merged', user_question, history_tables(conversation_history))
+    return f"""{context_str}The user asked: "{user_question}"
+My database is ONLY about sales, products, and customers. Its MySQL schema is:
+{schema}
+First decide whether the question is answerable using ONLY this data. Then reply with a JSON object and nothing else:
+{{"relevant": "YES" or "NO", "sql": a single, valid MySQL SELECT query answering the question, or null when relevant is NO}}"""
+
+def merged_request(user_question, conversation_history=None):
+    return dict(
+        messages=[SystemMessage("You are a relevancy checker and an expert SQL query generator."),
+                  UserMessage(build_merged_prompt(user_question, conversation_history))],
+        model=MODEL, temperature=0.0
+    )
+
+def parse_merged_answer(content):
+    """Returns (is_relevant, sql) from the JSON object produced for merged_request()."""
+    content = content.strip()
+    match = re.search(r"\{.*\}", content, re.DOTALL)
+    verdict = json.loads(match.group(0) if match else content)
+    answer = str(verdict.get("relevant", "")).upper()
+    if "YES" not in answer and "NO" not in answer:
+        raise ValueError(f"No relevance verdict in the model's answer: {content[:200]}")
+    relevant = "YES" in answer
+    return relevant, (verdict.get("sql") or None) if relevant else None
+
+def generate_relevance_and_sql(user_question, conversation_history=None):
+    """One structured completion returning (is_relevant, sql); (None, None) when the model
+    call failed or its answer could not be parsed."""
+    try:
+        response = llm_complete('merged', merged_request(user_question, conversation_history))
+        return parse_merged_answer(response.choices[0].message.content)
+    except Exception as e:
+        print(f"Error in generate_relevance_and_sql: {e}")
+        return None, None
+
+def merged_relevance_and_sql(user_question, conversation_history, cache_question):
+    if conversation_history:
+        return generate_relevance_and_sql(user_question, conversation_history)
+    return tuple(single_flight(f"merged:{cache_question}", lambda: list(generate_relevance_and_sql(user_question))))
+
+def parallel_relevance_and_sql(user_question, conversation_history, cache_question):
+    """Both calls at once; the SQL is dropped unless the question turns out relevant."""
+    # Each call runs in a copy of this context so it shares the request's Redis layer.
+    relevance_future = llm_executor.submit(contextvars.copy_context().run, is_query_relevant, user_question, cache_question)
+    sql_future = llm_executor.submit(contextvars.copy_context().run, generate_sql, user_question, conversation_history, cache_question, False)
+    relevant = relevance_future.result()
+    if relevant:
+        return relevant, sql_future.result()
+    sql_future.cancel()
+    return relevant, None
+
+def plan_steps(user_question, conversation_history, cache_question, mode, latency_prefix=''):
+    """Runs the relevance check and SQL generation according to `mode` (see QUERY PIPELINE).
+    Returns (is_relevant, raw_sql); raw_sql is None when the question is rejected, and
+    is_relevant is None when the model could not be asked (nothing is cached then)."""
+    cached_relevance = yield ('cached', f"relevance:{cache_question}")
+    if cached_relevance is False:
+        record_stat('relevance_cache_hit')
+        return False, None
+    start = time.perf_counter()
+    if cached_relevance is not None or mode == 'sequential':
+        relevant = yield ('relevance', user_question, cache_question)
+        raw_sql = (yield ('sql', user_question, conversation_history, cache_question)) if relevant else None
+        if cached_relevance is None:
+            record_latency(f"{latency_prefix}sequential", time.perf_counter() - start)
+        return relevant, raw_sql
+
+    if mode == 'merged':
+        cached_sql = None if conversation_history else (yield ('cached', f"sql:{cache_question}"))
+        if cached_sql:
+            # SQL survived but the verdict expired: only the cheap check is needed.
+            relevant = yield ('relevance', user_question, cache_question)
+            return relevant, cached_sql if relevant else None
+        record_stat('relevance_cache_miss')
+        relevant, raw_sql = yield ('merged', user_question, conversation_history, cache_question)
+        if relevant is not None:
+            yield ('cache', f"relevance:{cache_question}", relevant)
+    else:
+        relevant, raw_sql = yield ('parallel', user_question, conversation_history, cache_question)
+    if raw_sql and not conversation_history:
+        yield ('store_sql', cache_question, raw_sql)
+    record_latency(f"{latency_prefix}{mode}", time.perf_counter() - start)
+    return relevant, raw_sql
+
+@timed('plan')
+def plan_query(user_question, conversation_history=None, cache_question=None, mode=None):
+    """plan_steps() with this module's I/O."""
+    cache_question = cache_question or canonicalize_question(user_question)
+    return run_steps(plan_steps(user_question, conversation_history, cache_question, mode or LLM_PIPELINE_MODE), SYNC_IO)
+
+def correction_request(user_question, original_sql, error_message):
     prompt = f"""A user asked: "{user_question}"
 I generated this SQL query:
 "{original_sql}"
@@ -228,70 +1477,1263 @@ However, it failed with the following MySQL error:
 Based on the schema below and the error, please generate a corrected, valid MySQL SELECT query. Only output the corrected SQL query itself.
 
 Schema:
-{DB_SCHEMA}
+{prompt_schema('correction', user_question, sql_tables(original_sql))}
 """
+    return dict(
+        messages=[SystemMessage("You are a SQL query debugging expert."), UserMessage(prompt)],
+        model=MODEL, temperature=0.2
+    )
+
+# Corrections that worked and diagnoses are cached by error_fingerprint(): the failing
+# statement's fingerprint plus the normalized database error, so a bad pattern the model
+# keeps producing (e.g. a made-up column) is fixed or explained without another model call.
+CORRECTION_CACHE_TTL = int(os.getenv('CORRECTION_CACHE_TTL', 86400))
+
+def normalize_error_message(error):
+    """The database's own message for `error`, without the SQL, the background link and the
+    error number prefix that SQLAlchemy and the drivers add, lower-cased."""
+    message = str(getattr(error, 'orig', error))
+    message = re.sub(r'^\s*\d+\s*\([\w ]+\):\s*', '', message)            # mysql-connector: 1054 (42S22): ...
+    message = re.sub(r'^\(\s*\d+\s*,\s*([\'"])(.*)\1\s*\)$', r'\2', message)  # aiomysql: (1054, "...")
+    return re.sub(r'\s+', ' ', message).strip().lower()
+
+def error_fingerprint(sql_query, error):
+    key = f"{sql_fingerprint(sql_query)}:{mysql_errno(error)}:{normalize_error_message(error)}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def remember_correction(error_key, corrected_sql, cache_question=None):
+    """Caches a correction that ran, and makes it the question's cached SQL."""
+    cache_response(f"correction:{error_key}", corrected_sql, ttl=CORRECTION_CACHE_TTL)
+    if cache_question:
+        store_generated_sql(cache_question, corrected_sql)
+
+def forget_correction(error_key):
+    """Drops a cached correction that failed in turn (e.g. after a schema change)."""
+    if not redis_client: return
     try:
-        response = client.complete(
-            messages=[SystemMessage("You are a SQL query debugging expert."), UserMessage(prompt)],
-            model=MODEL, temperature=0.2
-        )
+        request_redis().queue('delete', f"correction:{error_key}")
+    except Exception as e:
+        print(f"Cache error: {e}")
+
+def generate_corrected_sql(user_question, original_sql, error_message, error_key=None):
+    """Asks the AI to correct a faulty SQL query, unless a correction already worked for
+    the same failure (`error_key`, see error_fingerprint)."""
+    if not error_key:
+        return request_correction(user_question, original_sql, error_message)
+    cached_sql = get_cached_response(f"correction:{error_key}")
+    if cached_sql:
+        record_stat('correction_cache_hit')
+        return cached_sql
+    record_stat('correction_cache_miss')
+    return single_flight(f"correction:{error_key}", lambda: request_correction(user_question, original_sql, error_message))
+
+def request_correction(user_question, original_sql, error_message):
+    try:
+        response = llm_complete('correction', correction_request(user_question, original_sql, error_message))
         return response.choices[0].message.content
     except Exception as e:
         print(f"Error in generate_corrected_sql: {e}")
         return None
 
-def diagnose_sql_error(user_question, sql_query, error_message):
+DIAGNOSIS_FALLBACK = "I couldn't run that query. It might be asking for information that isn't in the database."
+
+def diagnosis_request(user_question, sql_query, error_message):
+    prompt = f"""A user asked: "{user_question}"\nI generated this SQL: "{sql_query}"\nThe database returned this error: "{error_message}"\n\nBased on the schema below, explain the problem to the user in a simple, friendly way and suggest a valid alternative question.\n\nSchema:\n{prompt_schema('diagnosis', user_question, sql_tables(sql_query))}"""
+    return dict(
+        messages=[SystemMessage("You are a helpful database assistant."), UserMessage(prompt)],
+        model=MODEL, temperature=0.7
+    )
+
+def diagnose_sql_error(user_question, sql_query, error_message, error_key=None):
     # This function is now mainly a final fallback
-    prompt = f"""A user asked: "{user_question}"\nI generated this SQL: "{sql_query}"\nThe database returned this error: "{error_message}"\n\nBased on the schema below, explain the problem to the user in a simple, friendly way and suggest a valid alternative question.\n\nSchema:\n{DB_SCHEMA}"""
+    if error_key:
+        cached_diagnosis = get_cached_response(f"diagnosis:{error_key}")
+        if cached_diagnosis:
+            record_stat('diagnosis_cache_hit')
+            return cached_diagnosis
+        record_stat('diagnosis_cache_miss')
     try:
-        response = client.complete(
-            messages=[SystemMessage("You are a helpful database assistant."), UserMessage(prompt)],
-            model=MODEL, temperature=0.7
+        response = llm_complete('diagnosis', diagnosis_request(user_question, sql_query, error_message))
+        diagnosis = response.choices[0].message.content
+        if error_key:
+            cache_response(f"diagnosis:{error_key}", diagnosis, ttl=CORRECTION_CACHE_TTL)
+        return diagnosis
+    except Exception as e:
+        print(f"Error in diagnose_sql_error: {e}")
+        return DIAGNOSIS_FALLBACK
+
+# --- QUERY GUARD ---
+# Before a query runs, MySQL's EXPLAIN row estimates are checked against
+# QUERY_MAX_ESTIMATED_ROWS; over-budget queries are rejected or, with
+# QUERY_OVER_BUDGET=rewrite, sent back to the model once for a cheaper version.
+# Every MySQL session gets MAX_EXECUTION_TIME, and at most DB_MAX_CONCURRENT_QUERIES
+# queries run at once per worker so bursts queue here instead of draining the pool.
+QUERY_MAX_ESTIMATED_ROWS = int(os.getenv('QUERY_MAX_ESTIMATED_ROWS', 10000000))
+QUERY_OVER_BUDGET = os.getenv('QUERY_OVER_BUDGET', 'rewrite')
+if QUERY_OVER_BUDGET not in ('reject', 'rewrite'):
+    raise ValueError("QUERY_OVER_BUDGET must be 'reject' or 'rewrite'")
+QUERY_TIMEOUT_MS = int(os.getenv('QUERY_TIMEOUT_MS', 30000))
+DB_MAX_CONCURRENT_QUERIES = int(os.getenv('DB_MAX_CONCURRENT_QUERIES', 8))
+DB_QUEUE_TIMEOUT = float(os.getenv('DB_QUEUE_TIMEOUT', 10))
+MYSQL_QUERY_TIMEOUT_ERRNO = 3024
+
+class QueryTooExpensive(ValueError):
+    def __init__(self, estimated_rows):
+        self.estimated_rows = estimated_rows
+        super().__init__(
+            f"This question would make the database examine about {estimated_rows:,} rows, more than the "
+            f"{QUERY_MAX_ESTIMATED_ROWS:,} allowed. Try narrowing it down, for example to a date range, category or customer."
         )
+
+class QueryTimedOut(ValueError):
+    def __init__(self):
+        super().__init__(f"The query was stopped after {QUERY_TIMEOUT_MS / 1000:g} seconds. Try a narrower question, for example a shorter date range.")
+
+class DatabaseBusy(Exception):
+    pass
+
+def set_session_limits(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"SET SESSION MAX_EXECUTION_TIME = {QUERY_TIMEOUT_MS}")
+    cursor.close()
+
+if engine.dialect.name == 'mysql' and QUERY_TIMEOUT_MS:
+    event.listen(engine, 'connect', set_session_limits)
+
+def mysql_errno(error):
+    """The MySQL error number behind a SQLAlchemy error (mysql-connector or aiomysql), or None."""
+    orig = getattr(error, 'orig', error)
+    errno = getattr(orig, 'errno', None)
+    if errno is None and getattr(orig, 'args', None) and isinstance(orig.args[0], int):
+        errno = orig.args[0]
+    return errno
+
+def estimate_examined_rows(plan):
+    """Rows MySQL expects to examine for an EXPLAIN plan. Tables sharing a SELECT id form
+    a nested-loop join: each is read once per row that survives the tables before it."""
+    total, fanout, select_id = 0, 1.0, object()
+    for row in plan:
+        if row.get('id') != select_id:
+            fanout, select_id = 1.0, row.get('id')
+        examined = fanout * float(row.get('rows') or 1)
+        total += examined
+        fanout = examined * float(row.get('filtered') or 100) / 100
+    return int(total)
+
+def admit_query(connection, sql_query):
+    """Raises QueryTooExpensive when the query's estimated cost is over budget. Only MySQL's
+    EXPLAIN has row estimates; elsewhere this is just the server-mode validation."""
+    if engine.dialect.name != 'mysql':
+        if SQL_VALIDATION_MODE == 'server' and not is_validated(sql_query):
+            explain_sql(connection, sql_query)
+        return
+    estimated_rows = estimate_examined_rows(explain_sql(connection, sql_query))
+    if estimated_rows > QUERY_MAX_ESTIMATED_ROWS:
+        record_stat('query_over_budget')
+        raise QueryTooExpensive(estimated_rows)
+
+db_slots = threading.BoundedSemaphore(DB_MAX_CONCURRENT_QUERIES)
+
+def acquire_db_slot():
+    start = time.perf_counter()
+    acquired = db_slots.acquire(timeout=DB_QUEUE_TIMEOUT)
+    observe_stage('db_queue_wait', time.perf_counter() - start)
+    if not acquired:
+        record_stat('db_queue_timeout')
+        raise DatabaseBusy("The database is busy right now. Please try again in a moment.")
+
+def rewrite_request(user_question, sql_query, estimated_rows):
+    prompt = f"""A user asked: "{user_question}"
+I generated this SQL query:
+"{sql_query}"
+
+MySQL estimates it would examine about {estimated_rows:,} rows, more than the limit of {QUERY_MAX_ESTIMATED_ROWS:,}. Rewrite it as a single MySQL SELECT query that answers the same question while examining far fewer rows: join only on key columns, filter as early as possible, use indexed columns, and avoid cross joins. Only output the SQL query itself.
+
+Schema:
+{prompt_schema('rewrite', user_question, sql_tables(sql_query))}
+"""
+    return dict(
+        messages=[SystemMessage("You are a MySQL query optimization expert."), UserMessage(prompt)],
+        model=MODEL, temperature=0.0
+    )
+
+def generate_cheaper_sql(user_question, sql_query, estimated_rows):
+    try:
+        response = llm_complete('rewrite', rewrite_request(user_question, sql_query, estimated_rows))
         return response.choices[0].message.content
     except Exception as e:
-        print(f"Error in diagnose_sql_error: {e}")
-        return "I couldn't run that query. It might be asking for information that isn't in the database."
+        print(f"Error in generate_cheaper_sql: {e}")
+        return None
+
+# --- RESULT-SET CACHE ---
+# Rows are cached under a fingerprint of the normalized SQL. Each entry records the
+# version of every table it read; bumping a table's version (e.g. after the nightly
+# sales load) invalidates only the entries that depend on it.
+# Table versions can't tell when rows that depend on the clock go stale, so those are only
+# cached for CLOCK_RESULT_CACHE_TTL seconds, and rows that depend on random values not at all.
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 3600))
+CLOCK_RESULT_CACHE_TTL = int(os.getenv('CLOCK_RESULT_CACHE_TTL', 60))
+CLOCK_FUNCTIONS = frozenset({
+    'CURDATE', 'CURRENT_DATE', 'CURTIME', 'CURRENT_TIME', 'CURRENT_TIMESTAMP', 'NOW', 'SYSDATE',
+    'LOCALTIME', 'LOCALTIMESTAMP', 'UTC_DATE', 'UTC_TIME', 'UTC_TIMESTAMP', 'UNIX_TIMESTAMP',
+})
+RANDOM_FUNCTIONS = frozenset({'RAND', 'UUID', 'UUID_SHORT', 'RANDOM_BYTES'})
+
+def result_cache_ttl(sql_query):
+    """Seconds to cache the statement's rows; 0 when they must not be cached."""
+    words = {token.value.upper() for token in sqlparse.parse(sql_query)[0].flatten() if token.ttype in T.Name or token.ttype in T.Keyword}
+    if words & RANDOM_FUNCTIONS:
+        return 0
+    if words & CLOCK_FUNCTIONS:
+        return min(CLOCK_RESULT_CACHE_TTL, RESULT_CACHE_TTL)
+    return RESULT_CACHE_TTL
+
+def normalize_sql(sql_query):
+    """Canonical form of a statement: comments dropped, whitespace collapsed, keywords
+    upper-cased, backticks removed and string literals single-quoted."""
+    parts = []
+    for token in sqlparse.parse(sql_query)[0].flatten():
+        if token.is_whitespace or token.ttype in T.Comment:
+            continue
+        value = token.value
+        if token.ttype in T.Keyword or token.ttype in T.Name.Builtin:
+            value = value.upper()
+        elif token.ttype in T.Name and value.startswith('`'):
+            value = value.strip('`')
+        elif token.ttype in T.Literal.String.Symbol and not re.search(r"['\\]", value[1:-1]):
+            value = f"'{value[1:-1]}'"
+        elif token.ttype in T.Literal.Number:
+            value = value.lower()
+        parts.append(value)
+    return " ".join(parts)
+
+def sql_fingerprint(sql_query):
+    return hashlib.sha1(normalize_sql(sql_query).encode('utf-8')).hexdigest()
 
-def execute_sql(sql_query):
-    """Execute SQL query within a transaction for safety."""
+def referenced_tables(sql_query):
+    names = {token.value.strip('`').lower() for token in sqlparse.parse(sql_query)[0].flatten() if token.ttype in T.Name}
+    return sorted(names.intersection(schema_catalog().columns))
+
+def _value_tag(value):
+    if value is None or isinstance(value, (bool, int, float, str)): return None
+    if isinstance(value, Decimal): return 'decimal'
+    if isinstance(value, pd.Timestamp): return 'timestamp'
+    if isinstance(value, datetime): return 'datetime'
+    if isinstance(value, date): return 'date'
+    if isinstance(value, timedelta): return 'timedelta'
+    raise TypeError(f"Unsupported result type: {type(value).__name__}")
+
+RESULT_ENCODERS = {
+    'decimal': str,
+    'timestamp': lambda v: v.isoformat(),
+    'datetime': lambda v: v.isoformat(),
+    'date': lambda v: v.isoformat(),
+    'timedelta': lambda v: v.total_seconds(),
+}
+RESULT_DECODERS = {
+    'decimal': Decimal,
+    'timestamp': pd.Timestamp,
+    'datetime': datetime.fromisoformat,
+    'date': date.fromisoformat,
+    'timedelta': lambda v: timedelta(seconds=v),
+}
+
+def encode_result_set(results):
+    """Serializes records to JSON-safe columns + row arrays, tagging values (Decimal, dates)
+    that JSON would otherwise flatten, so decoded rows are identical to the originals."""
+    columns = list(results[0].keys()) if results else []
+    rows, tags = [], {}
+    for record in results:
+        row = []
+        for column in columns:
+            value = record[column]
+            tag = _value_tag(value)
+            if tag:
+                tags[column] = tag
+                value = RESULT_ENCODERS[tag](value)
+            row.append(value)
+        rows.append(row)
+    return {"columns": columns, "tags": tags, "rows": rows}
+
+def decode_result_set(payload):
+    columns, tags = payload["columns"], payload["tags"]
+    decoders = [RESULT_DECODERS[tags[c]] if c in tags else None for c in columns]
+    return [
+        {c: (decode(v) if decode and v is not None else v) for c, decode, v in zip(columns, decoders, row)}
+        for row in payload["rows"]
+    ]
+
+def get_table_versions(tables):
+    if not tables: return {}
+    layer = request_redis()
+    keys = [f"table_version:{t}" for t in tables]
+    layer.read(keys)
+    return {t: layer.cached(key, int, default=0)[0] for t, key in zip(tables, keys)}
+
+def bump_table_versions(*tables):
+    """Invalidates every cached result set that read any of `tables`."""
+    if not redis_client: return
+    pipe = redis_client.pipeline()
+    for table in tables:
+        pipe.incr(f"table_version:{table}")
+        pipe.publish(CACHE_INVALIDATION_CHANNEL, invalidation_message(f"table_version:{table}"))
+    pipe.execute()
+    for table in tables:
+        local_cache.discard(f"table_version:{table}")
+
+def get_cached_result_set(sql_query):
+    cached = get_cached_result_entry(sql_query)
+    return cached[0] if cached else None
+
+def get_cached_result_entry(sql_query):
+    """(results, chart suggestion) from the result-set cache, or None."""
+    if not redis_client: return None
+    try:
+        cache_key = f"result:{sql_fingerprint(sql_query)}"
+        tables = referenced_tables(sql_query)
+        # The entry, the current versions of the tables it should depend on and, for a miss
+        # that could be answered from the rollups, their state, all in one round trip (none
+        # at all when the L1 cache holds them).
+        likely_miss = local_cache.get(cache_key) is MISSING
+        request_redis().read([cache_key] + [f"table_version:{t}" for t in tables] + (rollup_keys(tables) if likely_miss else []))
+        entry = get_cached_response(cache_key)
+        if entry and get_table_versions(list(entry["versions"])) == entry["versions"]:
+            record_stat('result_cache_hit')
+            return cached_result_value(entry)
+    except Exception as e:
+        print(f"Cache error: {e}")
+    record_stat('result_cache_miss')
+    return None
+
+def cached_result_value(entry):
+    """(results, chart suggestion) of a result-set cache entry."""
+    results = decode_result_set(entry["result"])
+    # Entries written before charts were cached carry none.
+    return results, entry["chart"] if "chart" in entry else analyze_and_suggest_chart(results)
+
+def shape_results(frame):
+    """(records, chart suggestion) for a query's DataFrame, with missing values as None."""
+    # The chart is picked from the frame itself, before it becomes records.
+    chart_suggestion = analyze_and_suggest_chart(frame)
+    return frame.astype(object).where(frame.notna(), None).to_dict(orient='records'), chart_suggestion
+
+def shape_rows(columns, rows):
+    """shape_results() for rows fetched without pandas (asgi.py), framed as pd.read_sql_query does."""
+    return shape_results(pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns, coerce_float=True))
+
+def cache_result_set(sql_query, results, chart_suggestion=None):
+    ttl = result_cache_ttl(sql_query)
+    if not redis_client or ttl <= 0: return
     try:
-        with engine.connect() as connection:
+        entry = {"versions": get_table_versions(referenced_tables(sql_query)), "result": encode_result_set(results), "chart": chart_suggestion}
+    except Exception as e:
+        print(f"Cache error: {e}")
+        return
+    cache_response(f"result:{sql_fingerprint(sql_query)}", entry, ttl=ttl)
+
+@timed('execute')
+def execute_sql(sql_query, connection=None, with_chart=False):
+    """Execute SQL query within a transaction for safety. A caller passing its own
+    `connection` already holds a database slot for it (see run_batch). With `with_chart`,
+    returns (results, chart suggestion); the suggestion is cached with the results."""
+    cached = get_cached_result_entry(sql_query)
+    if cached is None:
+        # Identical queries in flight share one execution; the others get the encoded rows.
+        computed = {}
+        def run():
+            computed['results'], computed['chart'] = run_sql(sql_query, connection)
+            return {"result": encode_result_set(computed['results']), "chart": computed['chart']}
+        shared = single_flight(f"result:{sql_fingerprint(sql_query)}", run, saves='db_queries')
+        cached = (computed['results'], computed['chart']) if 'results' in computed else (decode_result_set(shared['result']), shared['chart'])
+    return cached if with_chart else cached[0]
+
+def run_sql(sql_query, shared_connection=None):
+    query = rollup_sql(sql_query)
+    if not shared_connection:
+        acquire_db_slot()
+    try:
+        with (nullcontext(shared_connection) if shared_connection else db_connect()) as connection:
             with connection.begin():
-                result = pd.read_sql_query(text(sql_query), connection)
-                return result.to_dict(orient='records')
+                admit_query(connection, query)
+                result = pd.read_sql_query(text(query), connection)
+    except ValueError:
+        raise
+    except DBAPIError as e:
+        if mysql_errno(e) == MYSQL_QUERY_TIMEOUT_ERRNO:
+            record_stat('query_timeout')
+            raise QueryTimedOut() from e
+        print(f"Error executing SQL: {e}")
+        raise
     except Exception as e:
         print(f"Error executing SQL: {e}")
         raise
+    finally:
+        if not shared_connection:
+            db_slots.release()
+    results, chart_suggestion = shape_results(result)
+    cache_result_set(sql_query, results, chart_suggestion)
+    return results, chart_suggestion
 
-def analyze_and_suggest_chart(results):
-    if not results or not isinstance(results, list) or len(results) == 0:
-        return None
-    headers = list(results[0].keys())
-    if len(headers) != 2:
+# --- SALES ROLLUPS ---
+# Daily totals of `sales` per product category, per customer and per product, kept in
+# rollup_* tables that the schema catalog (and so the model) never sees. On a result
+# cache miss, an aggregate query that a rollup answers with identical rows is run
+# against the smallest such rollup instead of the raw join; the response still shows the
+# generated SQL. `flask refresh-rollups` (also run by bump-table-version for sales or
+# products) re-aggregates only the days that received sales rows since the last refresh,
+# and records the table versions it saw: the rollups are used only while those are
+# current, the same contract the result cache relies on.
+ROLLUP_REWRITE = os.getenv('ROLLUP_REWRITE', 'on') == 'on'
+ROLLUP_STATE_KEY = 'rollup:state'
+ROLLUP_SOURCE_TABLES = ('sales', 'products')
+ROLLUP_AGGREGATES = ('SUM', 'COUNT', 'MIN', 'MAX')
+ROLLUP_UNSAFE_WORDS = frozenset({'AVG', 'GROUP_CONCAT', 'STD', 'STDDEV', 'STDDEV_POP', 'STDDEV_SAMP', 'VARIANCE', 'VAR_POP',
+                                 'VAR_SAMP', 'BIT_AND', 'BIT_OR', 'BIT_XOR', 'JSON_ARRAYAGG', 'JSON_OBJECTAGG', 'ANY_VALUE',
+                                 'OVER', 'WINDOW', 'INTO', 'USING', 'WITH', 'WITH ROLLUP'})
+
+# Smallest first: a query goes to the first rollup that can answer it. Each day is split
+# by `grain`; revenue is SUM(quantity * price) at the time of the refresh.
+ROLLUPS = {
+    'rollup_sales_category_daily': {
+        'grain': 'category',
+        'columns': "sale_date DATE NOT NULL, category VARCHAR(100), sale_count BIGINT NOT NULL, quantity BIGINT NOT NULL, revenue DECIMAL(20,2)",
+        'select': "SELECT s.sale_date, p.category, COUNT(*), SUM(s.quantity), SUM(s.quantity * p.price) "
+                  "FROM sales s JOIN products p ON s.product_id = p.id WHERE {rows} GROUP BY s.sale_date, p.category",
+    },
+    'rollup_sales_customer_daily': {
+        'grain': 'customer_id',
+        'columns': "sale_date DATE NOT NULL, customer_id INT, sale_count BIGINT NOT NULL, quantity BIGINT NOT NULL, revenue DECIMAL(20,2)",
+        'select': "SELECT s.sale_date, s.customer_id, COUNT(*), SUM(s.quantity), SUM(s.quantity * p.price) "
+                  "FROM sales s LEFT JOIN products p ON s.product_id = p.id WHERE {rows} GROUP BY s.sale_date, s.customer_id",
+    },
+    'rollup_sales_product_daily': {
+        'grain': 'product_id',
+        'columns': "sale_date DATE NOT NULL, product_id INT, sale_count BIGINT NOT NULL, quantity BIGINT NOT NULL",
+        'select': "SELECT s.sale_date, s.product_id, COUNT(*), SUM(s.quantity) "
+                  "FROM sales s WHERE {rows} GROUP BY s.sale_date, s.product_id",
+    },
+}
+
+class RollupQuery:
+    """A SELECT over `sales`, inner-joined to at most `products` and `customers`, with
+    GROUP BY or aggregates, split into the tokens rewrite() edits. Raises ValueError for
+    any other statement (subqueries, unions, outer joins, window functions, ...)."""
+
+    def __init__(self, sql_query):
+        self.flat = list(sqlparse.parse(sql_query)[0].flatten())
+        self.at = [i for i, t in enumerate(self.flat) if not t.is_whitespace and t.ttype not in T.Comment]
+        tokens = self.tokens = [self.flat[i] for i in self.at]
+        upper = self.upper = [' '.join(t.value.upper().split()) for t in tokens]
+        if upper[:1] != ['SELECT'] or upper.count('SELECT') != 1 or ROLLUP_UNSAFE_WORDS.intersection(upper):
+            raise ValueError("not a single plain SELECT")
+
+        # frames[k]: the (function, index of '(') of every parenthesis around token k.
+        stack, self.frames, self.close = [], [], {}
+        for k, token in enumerate(tokens):
+            if upper[k] == ')':
+                if not stack:
+                    raise ValueError("unbalanced parentheses")
+                self.close[stack.pop()[1]] = k
+            self.frames.append(tuple(stack))
+            if upper[k] == '(':
+                is_call = k > 0 and (tokens[k - 1].ttype in T.Name or tokens[k - 1].ttype in T.Keyword)
+                stack.append((upper[k - 1] if is_call else None, k))
+        if stack:
+            raise ValueError("unbalanced parentheses")
+        self.calls = [o for o in self.close if o > 0 and upper[o - 1] in ROLLUP_AGGREGATES]
+
+        clauses = [k for k in range(len(tokens)) if not self.frames[k] and upper[k] in ('FROM', 'WHERE', 'GROUP BY', 'HAVING', 'ORDER BY', 'LIMIT')]
+        if not clauses or upper[clauses[0]] != 'FROM':
+            raise ValueError("no FROM clause")
+        if 'GROUP BY' not in (upper[k] for k in clauses) and not self.calls:
+            raise ValueError("not an aggregate query")
+        end = clauses[1] if len(clauses) > 1 else len(tokens)
+        self.from_at = clauses[0]
+
+        # FROM: table [AS] [alias] [ON ...], separated by commas or inner joins.
+        self.tables, self.order, self.consumed = {}, [], set()
+        k, join_at = clauses[0] + 1, None
+        while k < end:
+            if tokens[k].ttype not in T.Name or upper[k + 1:k + 2] == ['.'] or self.name(k) in self.tables:
+                raise ValueError("unsupported FROM clause")
+            table = self.name(k)
+            segment = self.tables[table] = {'name_at': k, 'join_at': join_at, 'alias': None, 'on': None}
+            self.order.append(table)
+            self.consumed.add(k)
+            k += 1
+            if k < end and upper[k] == 'AS':
+                k += 1
+            if k < end and tokens[k].ttype in T.Name:
+                segment['alias'] = self.name(k)
+                self.consumed.add(k)
+                k += 1
+            if k < end and upper[k] == 'ON':
+                start = k
+                while k < end and not (not self.frames[k] and (upper[k] == ',' or upper[k].endswith('JOIN'))):
+                    k += 1
+                segment['on'] = (start, k)
+            if k < end:
+                if upper[k] not in (',', 'JOIN', 'INNER JOIN'):
+                    raise ValueError(f"unsupported join: {upper[k]}")
+                join_at = k
+                k += 1
+        if 'sales' not in self.tables or set(self.tables) - {'sales', 'products', 'customers'}:
+            raise ValueError("not a query over sales, products and customers")
+        self.aliases = {segment['alias'] or table: table for table, segment in self.tables.items()}
+
+        # Every column reference as (token index, table, column); select aliases are skipped.
+        columns = schema_catalog().columns
+        self.refs = []
+        for k, token in enumerate(tokens):
+            if k in self.consumed or token.ttype not in T.Name or upper[k + 1:k + 2] in (['('], ['.']) or upper[k - 1:k] == ['AS']:
+                continue
+            column = self.name(k)
+            if upper[k - 1:k] == ['.']:
+                table = self.aliases.get(self.name(k - 2))
+                if table is None:
+                    raise ValueError(f"unknown qualifier {self.name(k - 2)}")
+            else:
+                owners = [t for t in self.tables if column in columns.get(t, ())]
+                if len(owners) > 1:
+                    raise ValueError(f"ambiguous column {column}")
+                if not owners:
+                    continue
+                table = owners[0]
+            self.refs.append((k, table, column))
+
+    def name(self, k):
+        return self.tokens[k].value.strip('`').lower()
+
+    def is_distinct(self, call):
+        return self.upper[call + 1] == 'DISTINCT'
+
+    def products_join(self):
+        """Token indices that drop the products join, or None unless it is an inner join on
+        exactly `products.id = sales.product_id` (either way round)."""
+        sales, products = self.tables['sales'], self.tables['products']
+        if self.order[:2] == ['products', 'sales']:
+            # FROM products p JOIN sales s ON ...: drop "products p JOIN" and the ON clause.
+            join_at, on = sales['join_at'], sales['on']
+            drop = set(range(products['name_at'], sales['name_at']))
+        else:
+            # ... JOIN products p ON ...: drop everything from JOIN up to the ON clause.
+            join_at, on = products['join_at'], products['on']
+            drop = set(range(join_at, on[0])) if join_at is not None and on else set()
+        if join_at is None or on is None or self.upper[join_at] == ',':
+            return None
+        parts = list(range(on[0] + 1, on[1]))
+        if len(parts) != 7 or [self.upper[k] for k in parts[1::2]] != ['.', '=', '.']:
+            return None
+        sides = {(self.aliases.get(self.name(parts[0])), self.name(parts[2])), (self.aliases.get(self.name(parts[4])), self.name(parts[6]))}
+        if sides != {('products', 'id'), ('sales', 'product_id')}:
+            return None
+        return drop | set(range(*on))
+
+    def rewrite(self, rollup, grain, orphan_products=0):
+        """This query reading `rollup` instead of sales, or None when that would change its rows."""
+        sales_alias = self.tables['sales']['alias'] or 'sales'
+        dimensions = {'sale_date', grain}
+        joined = set(self.tables)
+        if 'customers' in joined and grain != 'customer_id':
+            return None
+        # Rows without a product drop out of an inner join with products but not out of
+        # the customer rollup, and are missing from the category rollup.
+        if orphan_products and grain != 'product_id' and ('products' in joined) == (grain == 'customer_id'):
+            return None
+        edits, dropped = {}, set()
+        if 'products' in joined and grain != 'product_id':
+            dropped = self.products_join()
+            if dropped is None:
+                return None
+            edits.update({k: '' for k in dropped})
+
+        quantities, prices = defaultdict(list), defaultdict(list)   # per SUM call
+        for k, table, column in self.refs:
+            if k in dropped:
+                continue
+            frames = self.frames[k]
+            inner = frames[-1][1] if frames else None
+            aggregates = [o for _, o in frames if o in self.calls]
+            if table == 'sales':
+                if column in dimensions:
+                    if any(self.upper[o - 1] in ('SUM', 'COUNT') and not self.is_distinct(o) for o in aggregates):
+                        return None
+                elif column == 'quantity' and inner in self.calls and self.upper[inner - 1] == 'SUM':
+                    quantities[inner].append(k)
+                elif not (column == 'id' and inner in self.calls and self.upper[inner - 1] == 'COUNT' and self.close[inner] == k + 1):
+                    return None
+            elif table == 'products' and grain != 'product_id':
+                if column == 'price' and inner in self.calls and self.upper[inner - 1] == 'SUM':
+                    prices[inner].append(k)
+                elif column == 'category' and grain == 'category':
+                    if any(self.upper[o - 1] in ('SUM', 'COUNT') and not self.is_distinct(o) for o in aggregates):
+                        return None
+                    if self.upper[k - 1:k] == ['.']:
+                        edits[k - 2] = sales_alias
+                else:
+                    return None
+
+        for k, token in enumerate(self.tokens):
+            if token.ttype in T.Wildcard and not (self.frames[k] and self.frames[k][-1][1] in self.calls and self.upper[k - 2] == 'COUNT'):
+                return None
+        for call in self.calls:
+            function, args = self.upper[call - 1], range(call + 1, self.close[call])
+            if function == 'SUM':
+                # SUM(quantity * factor * ...): the daily sum times the same factors is the same total.
+                if self.is_distinct(call) or len(quantities[call]) != 1 or len(prices[call]) > 1:
+                    return None
+                for k in args:
+                    token = self.tokens[k]
+                    if len(self.frames[k]) != len(self.frames[call]) + 1 or not (
+                            token.ttype in T.Name or self.upper[k] in ('.', '*')
+                            or token.ttype in T.Literal.Number and 'E' not in self.upper[k]):
+                        return None
+                if any(k in args and k not in quantities[call] for k, table, _ in self.refs if table == 'sales'):
+                    return None
+                if prices[call]:
+                    # quantity * price -> revenue: drop the price operand and one '*'.
+                    price = prices[call][0]
+                    operand = range(price - 2, price + 1) if self.upper[price - 1:price] == ['.'] else range(price, price + 1)
+                    operator = operand.start - 1 if operand.start - 1 in args else operand.stop
+                    if self.upper[operator] != '*':
+                        return None
+                    edits.update({k: '' for k in [*operand, operator]})
+                    edits[quantities[call][0]] = 'revenue'
+            elif function == 'COUNT' and not self.is_distinct(call):
+                # COUNT(*), COUNT(1) and COUNT(sales.id) count sales rows: add up the daily counts.
+                argument = [self.tokens[k] for k in args]
+                counts_rows = (len(argument) == 1 and (argument[0].ttype in T.Wildcard or argument[0].ttype in T.Literal.Number.Integer)
+                               or len(argument) in (1, 3) and any(k == self.close[call] - 1 and table == 'sales' and column == 'id'
+                                                                  for k, table, column in self.refs))
+                if not counts_rows:
+                    return None
+                edits.update({k: '' for k in range(call, self.close[call] + 1)})
+                edits[call - 1] = f"CAST(COALESCE(SUM({sales_alias}.sale_count), 0) AS SIGNED)"
+
+        # An unaliased select item is named after its text, so keep the original name.
+        item = []
+        for k in range(2 if self.upper[1] == 'DISTINCT' else 1, self.from_at + 1):
+            if k < self.from_at and not (self.upper[k] == ',' and not self.frames[k]):
+                item.append(k)
+                continue
+            aliased = len(item) > 1 and (self.upper[item[-2]] == 'AS' or self.tokens[item[-1]].ttype in T.Name and self.upper[item[-2]] != '.')
+            column = self.tokens[item[-1]].ttype in T.Name and (len(item) == 1 or len(item) == 3 and self.upper[item[1]] == '.') if item else False
+            if item and not aliased and not column and any(i in edits for i in item):
+                original = "".join(token.value for token in self.flat[self.at[item[0]]:self.at[item[-1]] + 1])
+                if '`' in original:
+                    return None
+                edits[item[-1]] = edits.get(item[-1], self.tokens[item[-1]].value) + f" AS `{original}`"
+            item = []
+
+        sales = self.tables['sales']
+        edits[sales['name_at']] = rollup if sales['alias'] else f"{rollup} sales"
+        values = [token.value for token in self.flat]
+        for k, value in edits.items():
+            values[self.at[k]] = value
+        parts, after_space = [], False
+        for token, value in zip(self.flat, values):
+            if token.is_whitespace:
+                if after_space:
+                    continue  # whitespace left around dropped tokens
+                after_space = True
+            elif value:
+                after_space = False
+            parts.append(value)
+        return "".join(parts)
+
+def rewrite_for_rollups(sql_query, orphan_products=0):
+    """`sql_query` against the smallest rollup that returns exactly its rows, or None.
+    `orphan_products` is the number of sales rows without a matching product."""
+    try:
+        query = RollupQuery(sql_query)
+    except (ValueError, IndexError):
         return None
-    label_column, data_column = None, None
-    for header in headers:
-        if isinstance(results[0][header], (int, float, Decimal)):
-            data_column = header
+    for rollup, spec in ROLLUPS.items():
+        rewritten = query.rewrite(rollup, spec['grain'], orphan_products)
+        if rewritten:
+            return rewritten
+    return None
+
+def rollup_keys(tables):
+    """Redis keys route_to_rollups() needs for a query reading `tables`."""
+    if not ROLLUP_REWRITE or 'sales' not in tables:
+        return []
+    return [ROLLUP_STATE_KEY] + [f"table_version:{t}" for t in ROLLUP_SOURCE_TABLES]
+
+def route_to_rollups(sql_query, state, versions):
+    """The rollup rewrite of `sql_query` if `state` (from the last refresh) was built from
+    the current table `versions` and a rollup can answer it; otherwise `sql_query`."""
+    if not state or versions != state['versions']:
+        record_stat('rollup_stale')
+        return sql_query
+    rewritten = rewrite_for_rollups(sql_query, state['orphan_products'])
+    record_stat('rollup_rewrite' if rewritten else 'rollup_ineligible')
+    return rewritten or sql_query
+
+def rollup_sql(sql_query):
+    """The statement to run for `sql_query` (without Redis there is no freshness check,
+    so the rollups are not used)."""
+    if not ROLLUP_REWRITE or not redis_client or 'sales' not in referenced_tables(sql_query):
+        return sql_query
+    try:
+        request_redis().read(rollup_keys(['sales']))
+        state = get_cached_response(ROLLUP_STATE_KEY)
+        versions = get_table_versions(list(ROLLUP_SOURCE_TABLES))
+    except Exception as e:
+        print(f"Cache error: {e}")
+        return sql_query
+    return route_to_rollups(sql_query, state, versions)
+
+def create_rollup_tables(connection):
+    existing = set(inspect(connection).get_table_names())
+    if 'rollup_state' not in existing:
+        connection.execute(text("CREATE TABLE rollup_state (id INT PRIMARY KEY, watermark BIGINT NOT NULL, "
+                                "products_signature CHAR(40) NOT NULL, orphan_products BIGINT NOT NULL, refreshed_at DATETIME)"))
+    for rollup, spec in ROLLUPS.items():
+        if rollup not in existing:
+            connection.execute(text(f"CREATE TABLE {rollup} ({spec['columns']})"))
+            connection.execute(text(f"CREATE INDEX idx_{rollup} ON {rollup} (sale_date, {spec['grain']})"))
+
+def refresh_rollups(rebuild=False):
+    """Brings the rollups up to date with `sales`. Only days that received rows with an id
+    above the last refresh's watermark are re-aggregated; everything is rebuilt the first
+    time, when asked, or when product prices or categories changed. Updates or deletes of
+    existing sales rows need `rebuild`."""
+    versions = get_table_versions(list(ROLLUP_SOURCE_TABLES)) if redis_client else {}
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        create_rollup_tables(connection)
+        lock = " FOR UPDATE" if engine.dialect.name == 'mysql' else ""
+        state = connection.execute(text(f"SELECT watermark, products_signature, orphan_products FROM rollup_state WHERE id = 1{lock}")).first()
+        products = connection.execute(text("SELECT id, category, price FROM products ORDER BY id")).all()
+        signature = hashlib.sha1(repr(products).encode('utf-8')).hexdigest()
+        high = connection.execute(text("SELECT COALESCE(MAX(id), 0) FROM sales")).scalar()
+        full = rebuild or state is None or state.products_signature != signature or high < state.watermark
+        low, orphans = (0, 0) if full else (state.watermark, state.orphan_products)
+        params = {'low': low, 'high': high}
+        if full or high > low:
+            days = "sale_date IN (SELECT sale_date FROM sales WHERE id > :low AND id <= :high)"
+            for rollup, spec in ROLLUPS.items():
+                connection.execute(text(f"DELETE FROM {rollup}" + ("" if full else f" WHERE {days}")), params)
+                rows = "s.id <= :high" + ("" if full else f" AND s.{days}")
+                connection.execute(text(f"INSERT INTO {rollup} {spec['select'].format(rows=rows)}"), params)
+            orphans += connection.execute(text(
+                "SELECT COUNT(*) FROM sales s LEFT JOIN products p ON s.product_id = p.id "
+                "WHERE s.id > :low AND s.id <= :high AND p.id IS NULL"), params).scalar()
+        values = {'watermark': high, 'signature': signature, 'orphans': orphans, 'now': datetime.now()}
+        if state is None:
+            connection.execute(text("INSERT INTO rollup_state (id, watermark, products_signature, orphan_products, refreshed_at) "
+                                    "VALUES (1, :watermark, :signature, :orphans, :now)"), values)
+        else:
+            connection.execute(text("UPDATE rollup_state SET watermark = :watermark, products_signature = :signature, "
+                                    "orphan_products = :orphans, refreshed_at = :now WHERE id = 1"), values)
+    if redis_client:
+        pipe = redis_client.pipeline()
+        pipe.set(ROLLUP_STATE_KEY, json.dumps({"versions": versions, "orphan_products": orphans, "watermark": high}))
+        pipe.publish(CACHE_INVALIDATION_CHANNEL, invalidation_message(ROLLUP_STATE_KEY))
+        pipe.execute()
+        local_cache.discard(ROLLUP_STATE_KEY)
+    print(f"Rollups {'rebuilt' if full else f'refreshed with {high - low} new sales rows'} through sales id {high} "
+          f"({orphans} rows without a product) in {time.perf_counter() - start:.1f}s")
+    return high - low
+
+# --- STREAMING RESULTS ---
+# Rows are read from an unbuffered cursor in chunks and sent as NDJSON records:
+# a header (sql_query, conversation_id, columns), one "rows" record per chunk and a
+# trailer (row_count, chart_suggestion), so no full copy of the result is ever built.
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 200))
+
+def wants_stream(data):
+    return bool(data.get('stream')) or 'application/x-ndjson' in request.headers.get('Accept', '')
+
+@timed('execute')
+def iter_sql_chunks(sql_query):
+    """Opens the query on a server-side cursor and returns (columns, chunks, close). The first
+    chunk is fetched eagerly so SQL errors surface while an error response (or
+    self-healing) is still possible."""
+    cached_results = get_cached_result_set(sql_query)
+    if cached_results is not None:
+        columns = list(cached_results[0].keys()) if cached_results else []
+        rows = [tuple(record.values()) for record in cached_results]
+        return columns, (rows[i:i + STREAM_CHUNK_SIZE] for i in range(0, len(rows), STREAM_CHUNK_SIZE)), lambda: None
+
+    query = rollup_sql(sql_query)
+    acquire_db_slot()
+    try:
+        connection = db_connect()
+    except Exception:
+        db_slots.release()
+        raise
+    cursor = None
+    try:
+        connection.begin()
+        admit_query(connection, query)
+        if engine.dialect.driver == 'mysqlconnector':
+            # SQLAlchemy always asks mysql-connector for buffered cursors, so go to the
+            # driver directly for an unbuffered one.
+            cursor = connection.connection.dbapi_connection.cursor(buffered=False)
+            try:
+                cursor.execute(query)
+            except engine.dialect.loaded_dbapi.Error as e:
+                raise DBAPIError.instance(query, None, e, engine.dialect.loaded_dbapi.Error)
+            columns = [column[0] for column in cursor.description]
+            fetch = cursor.fetchmany
         else:
-            label_column = header
-    if label_column and data_column:
-        chart_type = 'bar'
+            result = connection.execution_options(stream_results=True).execute(text(query))
+            columns = list(result.keys())
+            fetch = result.fetchmany
+        first = fetch(STREAM_CHUNK_SIZE)
+    except Exception as e:
+        connection.invalidate() if cursor is not None else connection.close()
+        db_slots.release()
+        if isinstance(e, DBAPIError) and mysql_errno(e) == MYSQL_QUERY_TIMEOUT_ERRNO:
+            record_stat('query_timeout')
+            raise QueryTimedOut() from e
+        raise
+
+    state = {'open': True, 'finished': False}
+
+    def close():
+        """Returns the connection and the query slot; safe to call more than once."""
+        if not state['open']:
+            return
+        state['open'] = False
+        if cursor is not None and not state['finished']:
+            # Unread rows would poison the pooled connection; drop it instead.
+            connection.invalidate()
+        elif cursor is not None:
+            cursor.close()
+        connection.close()
+        db_slots.release()
+
+    def chunks():
         try:
-            if pd.to_datetime(results[0][label_column], errors='coerce') is not pd.NaT:
-                 chart_type = 'line'
-        except Exception:
-            pass
-        return {"type": chart_type, "labels_column": label_column, "data_column": data_column}
+            chunk = first
+            while chunk:
+                yield chunk
+                chunk = fetch(STREAM_CHUNK_SIZE)
+            state['finished'] = True
+        finally:
+            close()
+    return columns, chunks(), close
+
+def stream_sql_response(sql_query, conversation_id, notice=None):
+    columns, chunks, close = iter_sql_chunks(sql_query)
+
+    def generate():
+        header = {"type": "header", "sql_query": sql_query, "conversation_id": conversation_id, "columns": columns}
+        if notice:
+            header["notice"] = notice
+        yield app.json.dumps(header) + "\n"
+        row_count, chart_suggestion = 0, None
+        try:
+            for chunk in chunks:
+                records = [dict(zip(columns, row)) for row in chunk]
+                if row_count == 0:
+                    chart_suggestion = analyze_and_suggest_chart(records, include_data=False)
+                row_count += len(records)
+                yield app.json.dumps({"type": "rows", "rows": records}) + "\n"
+        except Exception as e:
+            print(f"Error streaming SQL results: {e}")
+            yield app.json.dumps({"type": "error", "error": f"A database error occurred: {e}"}) + "\n"
+            return
+        yield app.json.dumps({"type": "trailer", "row_count": row_count, "chart_suggestion": chart_suggestion}) + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+    # Also release the connection if the client goes away before the body is read.
+    response.call_on_close(close)
+    return response
+
+# --- CHART SUGGESTIONS ---
+# The whole result is profiled column by column (kind, distinct values, nulls) to pick a
+# chart: a line over a date column or a bar over a category column, with one series per
+# numeric column or, for "date, category, number" results, per category. The suggestion
+# carries the chart data itself: line charts are downsampled with LTTB and bar charts cut
+# to CHART_MAX_POINTS, so its size doesn't grow with the row count.
+CHART_MAX_POINTS = int(os.getenv('CHART_MAX_POINTS', 500))
+CHART_MAX_SERIES = int(os.getenv('CHART_MAX_SERIES', 8))
+CHART_PROBE_ROWS = 1000
+DATE_PREFIX = re.compile(r'\d{4}-\d{2}')
+NUMERIC_KINDS = ('integer', 'floating', 'decimal', 'mixed-integer-float')
+
+def results_frame(results):
+    """`results` (records or the columnar form) as a DataFrame."""
+    if isinstance(results, pd.DataFrame):
+        return results
+    if isinstance(results, dict) and 'columns' in results:
+        return pd.DataFrame(results['rows'], columns=[column['name'] for column in results['columns']])
+    return pd.DataFrame.from_records(results)
+
+def profile_column(column):
+    """{'kind': 'number' | 'date' | 'category' | 'empty', 'distinct', 'nulls'} for a column,
+    plus the parsed 'values' of number and date columns."""
+    present = column.dropna()
+    profile = {'kind': 'category', 'nulls': int(len(column) - len(present))}
+    inferred = pd.api.types.infer_dtype(present, skipna=True)
+    if present.empty:
+        profile['kind'] = 'empty'
+    elif inferred in NUMERIC_KINDS and not pd.api.types.is_bool_dtype(column):
+        profile.update(kind='number', values=pd.to_numeric(column, errors='coerce').astype(float))
+    elif inferred in ('datetime64', 'datetime', 'date') or (inferred == 'string' and DATE_PREFIX.match(present.iloc[0])
+                                                              and present.str.match(DATE_PREFIX.pattern).all()):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            values = pd.to_datetime(column, errors='coerce', format='mixed' if inferred == 'string' else None)
+        if values.notna().sum() == len(present):
+            profile.update(kind='date', values=values)
+    profile['distinct'] = int(profile['values'].nunique() if 'values' in profile else present.nunique())
+    return profile
+
+def profile_columns(frame):
+    return {name: profile_column(frame[name]) for name in frame.columns}
+
+def lttb(x, y, budget):
+    """Indexes of the `budget` points of the line (x, y) that best keep its shape
+    (Largest-Triangle-Three-Buckets), always including the first and last point."""
+    n = len(x)
+    if n <= budget or budget < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, budget - 1).astype(int)  # budget - 2 buckets between the ends
+    selected = [0]
+    for i in range(budget - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x, next_y = x[end:edges[i + 2]].mean(), y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+        a = selected[-1]
+        areas = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        selected.append(start + int(np.argmax(areas)))
+    selected.append(n - 1)
+    return np.array(selected)
+
+def chart_label(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+def chart_series(frame, profiles, label_column, number_columns):
+    """(series name, numeric values) pairs, one per number column or, for a single number
+    column next to a low-cardinality category column, one per category (pivoted onto the
+    distinct labels). Returns (labels frame, series) or None."""
+    categories = [c for c, p in profiles.items() if c != label_column and p['kind'] in ('category', 'date')]
+    if not categories or profiles[label_column]['distinct'] == len(frame):  # other columns just describe each label
+        series = [(c, profiles[c]['values']) for c in number_columns[:CHART_MAX_SERIES]]
+        return frame[label_column], series
+    if len(categories) == 1 and len(number_columns) == 1 and profiles[categories[0]]['distinct'] <= CHART_MAX_SERIES:
+        pivot = pd.DataFrame({'label': frame[label_column], 'group': frame[categories[0]].astype(str),
+                              'value': profiles[number_columns[0]]['values']})
+        wide = pivot.pivot_table(index='label', columns='group', values='value', aggfunc='sum', sort=False)
+        return pd.Series(wide.index), [(str(group), wide[group].reset_index(drop=True)) for group in wide.columns]
     return None
 
+@timed('chart')
+def analyze_and_suggest_chart(results, include_data=True):
+    """A chart for the result, or None. `labels_column`/`data_column` name the x axis and
+    the first series; with `include_data` the (downsampled) labels and datasets are included."""
+    if results is None or isinstance(results, dict) and 'columns' not in results:
+        return None
+    if isinstance(results, (list, pd.DataFrame)) and len(results) > CHART_PROBE_ROWS and include_data:
+        # Column kinds don't change down a result, and the first rows already show when
+        # no chart fits (no series, or too many categories), so large results that can't
+        # be charted are never profiled in full.
+        if analyze_and_suggest_chart(results[:CHART_PROBE_ROWS], include_data=False) is None:
+            return None
+    frame = results_frame(results)
+    if frame.empty or len(frame.columns) < 2:
+        return None
+    profiles = profile_columns(frame)
+    number_columns = [c for c, p in profiles.items() if p['kind'] == 'number' and not (str(c).lower() == 'id' or str(c).lower().endswith('_id'))]
+    dates = [c for c, p in profiles.items() if p['kind'] == 'date']
+    labels = dates or [c for c, p in profiles.items() if p['kind'] == 'category']
+    if not labels or not number_columns:
+        return None
+    chart_type, label_column = ('line' if dates else 'bar'), labels[0]
+    built = chart_series(frame, profiles, label_column, number_columns)
+    if built is None:
+        return None
+    label_values, series = built
+    suggestion = {"type": chart_type, "labels_column": label_column, "data_column": series[0][0],
+                  "series": [name for name, _ in series]}
+    if not include_data:
+        return suggestion
+
+    points = len(label_values)
+    if chart_type == 'line':
+        # Pivoted labels are the distinct dates, parsed again; otherwise the profile has them.
+        x = profiles[label_column]['values'] if len(label_values) == len(frame) else \
+            pd.to_datetime(label_values.astype(str), errors='coerce', format='mixed')
+        x_values = x.to_numpy().astype('datetime64[ns]').astype(np.int64).astype(float)
+        order = np.argsort(x_values, kind='stable')
+        x_values = x_values[order]
+        budget = max(3, CHART_MAX_POINTS // len(series))
+        keep = np.unique(np.concatenate([lttb(x_values, np.nan_to_num(values.to_numpy(dtype=float)[order]), budget)
+                                         for _, values in series]))
+        index = order[keep]
+    else:
+        index = np.arange(min(points, CHART_MAX_POINTS))
+    suggestion.update({
+        "labels": [chart_label(label) for label in label_values.iloc[index].tolist()],
+        "datasets": [{"label": name, "data": [None if math.isnan(v) else v for v in values.to_numpy(dtype=float)[index].tolist()]}
+                     for name, values in series],
+        "row_count": points,
+        "downsampled": len(index) < points,
+    })
+    return suggestion
+
+# --- RESPONSE FORMATS ---
+# "records" (default): results as a list of objects, as before.
+# "columnar": one columns header plus typed row arrays, gzip/brotli compressed when accepted.
+# "arrow": an Apache Arrow IPC stream, envelope fields in the schema metadata.
+RESPONSE_FORMATS = ('records', 'columnar', 'arrow')
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+COLUMN_TYPES = {'decimal': 'decimal', 'timestamp': 'datetime', 'datetime': 'datetime', 'date': 'date', 'timedelta': 'time'}
+
+def requested_format(data, headers):
+    if ARROW_MIMETYPE in headers.get('Accept', ''):
+        return 'arrow'
+    fmt = data.get('format', 'records')
+    return fmt if fmt in RESPONSE_FORMATS else 'records'
+
+def _json_type(value):
+    if isinstance(value, bool): return 'boolean'
+    if isinstance(value, int): return 'integer'
+    if isinstance(value, float): return 'number'
+    return 'string'
+
+def to_columnar(results):
+    """{"columns": [{"name", "type"}], "rows": [[...]]} with JSON-native values:
+    decimals as numbers, dates/datetimes as ISO strings, times as seconds."""
+    encoded = encode_result_set(results)
+    columns = []
+    for index, name in enumerate(encoded['columns']):
+        tag = encoded['tags'].get(name)
+        sample = next((row[index] for row in encoded['rows'] if row[index] is not None), None)
+        columns.append({'name': name, 'type': COLUMN_TYPES[tag] if tag else _json_type(sample) if sample is not None else 'null'})
+    decimal_columns = [i for i, c in enumerate(columns) if c['type'] == 'decimal']
+    rows = encoded['rows']
+    for row in rows:
+        for i, value in enumerate(row):
+            if isinstance(value, float) and value != value:
+                row[i] = None   # NaN is not valid JSON
+        for i in decimal_columns:
+            if row[i] is not None:
+                row[i] = float(row[i])
+    return {'columns': columns, 'rows': rows}
+
+def to_arrow(response_data):
+    import pyarrow as pa
+    results = response_data['results']
+    table = pa.Table.from_pylist(results) if results else pa.table({})
+    metadata = {key: json.dumps(value, default=str) for key, value in response_data.items() if key != 'results'}
+    table = table.replace_schema_metadata(metadata)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def accepted_encodings(accept_encoding):
+    """The codings we offer that an Accept-Encoding header allows (listed, or covered by "*",
+    with q > 0), the client's preferred first and brotli first on a tie."""
+    weights = {}
+    for item in accept_encoding.lower().split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            weights[coding] = q
+    offered = [(weights.get(coding, weights.get('*', 0.0)), coding) for coding in ('br', 'gzip')]
+    return [coding for q, coding in sorted(offered, key=lambda item: -item[0]) if q > 0]
+
+def compress_body(body, accept_encoding):
+    """Returns (body, content_encoding) using the best encoding the client accepts."""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    for coding in accepted_encodings(accept_encoding):
+        if coding == 'br':
+            try:
+                import brotli
+                return brotli.compress(body, quality=5), 'br'
+            except ImportError:
+                continue
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    return body, None
+
+def render_results(response_data, fmt, accept_encoding=''):
+    """Returns (body, mimetype, headers) for a successful answer in the requested format."""
+    if fmt == 'arrow':
+        body, mimetype = to_arrow(response_data), ARROW_MIMETYPE
+    else:
+        response_data = dict(response_data, results=to_columnar(response_data['results']), format='columnar')
+        body, mimetype = (app.json.dumps(response_data) + "\n").encode('utf-8'), 'application/json'
+    body, encoding = compress_body(body, accept_encoding)
+    headers = {'Vary': 'Accept-Encoding'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return body, mimetype, headers
+
+@timed('serialize')
+def format_response(response_data, fmt):
+    if fmt == 'records':
+        return jsonify(response_data)
+    try:
+        body, mimetype, headers = render_results(response_data, fmt, request.headers.get('Accept-Encoding', ''))
+    except ImportError:
+        return jsonify({"sql_query": response_data['sql_query'], "results": {"error": "Arrow output is not available on this server (pyarrow is not installed)."}, "conversation_id": response_data['conversation_id']}), 406
+    return Response(body, mimetype=mimetype, headers=headers)
+
 # --- GLOBAL RATE LIMIT CONFIG ---
 RATE_LIMITS = {
     'minute': {'key': 'requests:minute', 'limit': 10, 'expire': 60},
     'day': {'key': 'requests:day', 'limit': 50, 'expire': 86400}
 }
 
+def check_rate_limits(minute_count, day_count):
+    """Returns the error message for an exceeded global limit, or None."""
+    if minute_count > RATE_LIMITS['minute']['limit']:
+        # Optional: Decrement the counter since we are rejecting the request
+        # redis_client.decr(minute_key) 
+        # redis_client.decr(day_key)
+        return f"Global rate limit exceeded ({RATE_LIMITS['minute']['limit']}/min). Please wait and try again."
+    if day_count > RATE_LIMITS['day']['limit']:
+        # redis_client.decr(day_key) # Only need to decr the one that failed
+        return f"Global daily rate limit exceeded ({RATE_LIMITS['day']['limit']}/day). Please try again tomorrow."
+    return None
+
+def remember_history(history_key, user_question, sql_query):
+    if not redis_client: return
+    layer = request_redis()
+    layer.queue('lpush', history_key, json.dumps({"user_question": user_question, "sql_query": sql_query}))
+    layer.queue('ltrim', history_key, 0, HISTORY_LENGTH - 1)
+    layer.queue('expire', history_key, 3600)
+
+# --- QUERY PIPELINE ---
+# What happens between a question and its answer (pre-filter, relevance check and SQL
+# generation, self-healing, over-budget rewrites) is written once here for both this app
+# and asgi.py. The steps are generators that yield each I/O operation they need as
+# (name, *args) and are sent its result, or have its exception thrown in: run_steps()
+# performs the operations with the functions in SYNC_IO, asgi.run_steps() awaits their
+# async counterparts. 'answer' (run a validated query and build the response) is supplied
+# per request.
+REJECTED_MESSAGE = "I'm sorry, that question does not seem to be related to the available sales, product, or customer data."
+CORRECTED_NOTICE = "The initial query was automatically corrected."
+REWRITTEN_NOTICE = "The query was rewritten to stay within the database cost limit."
+
+def run_steps(steps, io):
+    value = error = None
+    while True:
+        try:
+            name, *args = steps.throw(error) if error else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value = error = None
+        try:
+            value = io[name](*args)
+        except Exception as e:
+            error = e
+
+def query_error(sql_query, message, status=200):
+    return {"sql_query": sql_query, "results": {"error": message}}, status
+
+def plan_error(relevant, raw_sql):
+    """The (body, status) for a question plan_steps() didn't produce SQL for, or None."""
+    if relevant is False:
+        return query_error("N/A (Query Rejected)", REJECTED_MESSAGE)
+    if not raw_sql:
+        return query_error("N/A", "The AI model could not generate a query.", 500)
+    return None
+
+def query_steps(user_question, conversation_history, cache_question, latency_prefix=''):
+    """Answers a question. Returns (answer, None) with the value of the 'answer' operation,
+    or (error body, HTTP status)."""
+    classification = pre_filter_question(user_question)
+    if classification:
+        return query_error("N/A (Query Rejected)", classification['message'])
+    with timed('plan'):
+        relevant, raw_sql = yield from plan_steps(user_question, conversation_history, cache_question, LLM_PIPELINE_MODE, latency_prefix)
+    return plan_error(relevant, raw_sql) or (yield from answer_steps(user_question, raw_sql, None if conversation_history else cache_question))
+
+def answer_steps(user_question, raw_sql, cache_question=None):
+    """Validates and answers `raw_sql`, asking the model to correct it when the database
+    rejects it (or validation finds a table or column it would reject) and to make it
+    cheaper when it is over the row budget. A correction that works becomes the cached SQL
+    of `cache_question`. A busy database is a 503 on every attempt. Returns like
+    query_steps()."""
+    sql_to_execute = None
+    try:
+        sql_to_execute = yield ('validate', raw_sql)
+        return (yield ('answer', sql_to_execute, None)), None
+
+    except (ProgrammingError, InvalidSQL) as e:
+        print(f"Initial SQL failed. Attempting self-healing. Error: {e}")
+        failed_sql = sql_to_execute or e.sql   # InvalidSQL from validation: nothing ran yet
+        error_key = error_fingerprint(failed_sql, e)
+        corrected_sql_raw = yield ('correct', user_question, failed_sql, str(e), error_key)
+        if not corrected_sql_raw:
+            return query_error(failed_sql, (yield ('diagnose', user_question, failed_sql, str(e), error_key)))
+        try:
+            corrected_sql = yield ('validate', corrected_sql_raw)
+            response = yield ('answer', corrected_sql, CORRECTED_NOTICE)
+            yield ('remember_correction', error_key, corrected_sql, cache_question)
+            print("Self-healing successful!")
+            return response, None
+        except DatabaseBusy as final_e:
+            return query_error(corrected_sql_raw, str(final_e), 503)
+        except (QueryTooExpensive, QueryTimedOut) as final_e:
+            return query_error(corrected_sql_raw, str(final_e))
+        except Exception as final_e:
+            print(f"Self-healing failed. Final error: {final_e}")
+            yield ('forget_correction', error_key)
+            diagnosis = yield ('diagnose', user_question, corrected_sql_raw, str(final_e), error_fingerprint(corrected_sql_raw, final_e))
+            return query_error(corrected_sql_raw, diagnosis)
+
+    except QueryTooExpensive as e:
+        print(f"Query over the row budget ({e.estimated_rows:,} rows estimated).")
+        cheaper_sql_raw = (yield ('cheaper', user_question, sql_to_execute, e.estimated_rows)) if QUERY_OVER_BUDGET == 'rewrite' else None
+        if cheaper_sql_raw:
+            try:
+                cheaper_sql = yield ('validate', cheaper_sql_raw)
+                return (yield ('answer', cheaper_sql, REWRITTEN_NOTICE)), None
+            except DatabaseBusy as final_e:
+                return query_error(cheaper_sql_raw, str(final_e), 503)
+            except (ValueError, DBAPIError) as final_e:
+                print(f"Rewritten query failed: {final_e}")
+                return query_error(cheaper_sql_raw, str(e) if isinstance(final_e, DBAPIError) else str(final_e))
+        return query_error(sql_to_execute, str(e))
+
+    except DatabaseBusy as e:
+        return query_error(sql_to_execute, str(e), 503)
+
+    except ValueError as e:
+        return query_error(raw_sql, str(e))
+
+    except Exception as e:
+        print(f"Generic execution error: {e}")
+        return query_error(sql_to_execute or raw_sql, f"A database error occurred: {e}", 500)
+
+SYNC_IO = {
+    'cached': get_cached_response,
+    'cache': cache_response,
+    'relevance': is_query_relevant,
+    'sql': generate_sql,
+    'merged': merged_relevance_and_sql,
+    'parallel': parallel_relevance_and_sql,
+    'store_sql': store_generated_sql,
+    'validate': clean_and_validate_sql,
+    'correct': generate_corrected_sql,
+    'remember_correction': remember_correction,
+    'forget_correction': forget_correction,
+    'diagnose': diagnose_sql_error,
+    'cheaper': generate_cheaper_sql,
+}
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -304,16 +2746,63 @@ def rate_limit_status():
             'day': {'count': 0, 'limit': RATE_LIMITS['day']['limit']},
             'error': 'Redis unavailable'
         })
-    minute_count = int(redis_client.get(RATE_LIMITS['minute']['key']) or 0)
-    day_count = int(redis_client.get(RATE_LIMITS['day']['key']) or 0)
+    minute_count, day_count = (int(count or 0) for count in redis_client.mget(RATE_LIMITS['minute']['key'], RATE_LIMITS['day']['key']))
     return jsonify({
         'minute': {'count': minute_count, 'limit': RATE_LIMITS['minute']['limit']},
         'day': {'count': day_count, 'limit': RATE_LIMITS['day']['limit']}
     })
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics, aggregated across workers when PROMETHEUS_MULTIPROC_DIR is set."""
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/stats')
+def stats():
+    """Per-worker cache counters and cache-miss pipeline latencies."""
+    hits = STATS['sql_cache_hit']
+    lookups = hits + STATS['sql_cache_miss']
+    l1_hits, l2_hits = STATS['cache_l1_hit'], STATS['cache_l2_hit']
+    l2_lookups = l2_hits + STATS['cache_miss']
+    return jsonify({
+        'cache': dict(STATS),
+        'pipeline': {
+            'mode': LLM_PIPELINE_MODE,
+            'latency_seconds': {
+                mode: {'count': len(samples), 'p50': round(percentile(samples, 50), 3), 'p95': round(percentile(samples, 95), 3)}
+                for mode, samples in LATENCIES.items() if samples
+            },
+        },
+        'sql_cache_hit_ratio': round(hits / lookups, 3) if lookups else None,
+        'similarity': {'threshold': SIMILARITY_THRESHOLD, 'indexed_questions': len(question_index.vectors)},
+        'redis_round_trips_per_request': round(STATS['redis_round_trips'] / STATS['redis_requests'], 2) if STATS['redis_requests'] else None,
+        'tiers': {
+            'l1_enabled': local_cache.enabled,
+            'l1_entries': len(local_cache.entries),
+            'l1_hit_ratio': round(l1_hits / (l1_hits + l2_lookups), 3) if l1_hits + l2_lookups else None,
+            'l2_hit_ratio': round(l2_hits / l2_lookups, 3) if l2_lookups else None,  # of the L1 misses
+        },
+    })
+
 @app.route('/query', methods=['POST'])
 def handle_query():
+    data = request.json
+    user_question = data.get('question', '').strip()
+    conversation_id = data.get('conversation_id')
+    stream = wants_stream(data)
+    fmt = requested_format(data, request.headers)
+    history_key = f"history:{conversation_id}"
+    canonical = canonicalize_question(user_question) if user_question else None
+    conversation_history = []
+
     # --- GLOBAL RATE LIMITING ---
+    # The same round trip also fetches the conversation history and the cached
+    # relevance verdict and SQL for the question. Near-duplicate matching (more Redis
+    # reads) only runs for requests within the limits.
     if redis_client:
         try:
             # Use a pipeline for an atomic transaction
@@ -329,21 +2818,22 @@ def handle_query():
             pipe.incr(day_key)
             pipe.expire(day_key, RATE_LIMITS['day']['expire'], nx=True)
 
+            if conversation_id:
+                pipe.lrange(history_key, 0, HISTORY_LENGTH - 1)
+            prefetch = [f"relevance:{canonical}", f"sql:{canonical}"] if canonical else []
+
             # Execute the transaction and get results
-            results = pipe.execute()
+            results = request_redis().read(prefetch, pipe)
             minute_count = results[0]
             day_count = results[2] # Index 2 because each INCR/EXPIRE pair returns two results
 
             # Enforce limits
-            if minute_count > RATE_LIMITS['minute']['limit']:
-                # Optional: Decrement the counter since we are rejecting the request
-                # redis_client.decr(minute_key) 
-                # redis_client.decr(day_key)
-                return jsonify({"sql_query": "N/A", "results": {"error": f"Global rate limit exceeded ({RATE_LIMITS['minute']['limit']}/min). Please wait and try again."}}), 429
-            
-            if day_count > RATE_LIMITS['day']['limit']:
-                # redis_client.decr(day_key) # Only need to decr the one that failed
-                return jsonify({"sql_query": "N/A", "results": {"error": f"Global daily rate limit exceeded ({RATE_LIMITS['day']['limit']}/day). Please try again tomorrow."}}), 429
+            rate_limit_error = check_rate_limits(minute_count, day_count)
+            if rate_limit_error:
+                return jsonify({"sql_query": "N/A", "results": {"error": rate_limit_error}}), 429
+
+            if conversation_id:
+                conversation_history = [json.loads(item) for item in reversed(results[4])]
 
         except redis.RedisError as e:
             # If Redis fails, what is the policy? Fail open or fail closed?
@@ -351,84 +2841,154 @@ def handle_query():
             print(f"CRITICAL: Redis error during rate limiting: {e}")
             return jsonify({"sql_query": "N/A", "results": {"error": "Could not contact rate limiting service. Please try again later."}}), 503 # Service Unavailable
 
-    data = request.json
-    user_question = data.get('question', '').strip()
-    conversation_id = data.get('conversation_id')
-
     if not user_question:
         return jsonify({"sql_query": "N/A", "results": {"error": "Please enter a question."}})
 
     if not conversation_id:
         conversation_id = str(uuid.uuid4())
-    
-    conversation_history = []
-    if redis_client:
         history_key = f"history:{conversation_id}"
-        raw_history = redis_client.lrange(history_key, 0, 4)
-        conversation_history = [json.loads(item) for item in reversed(raw_history)]
+    cache_question = find_cache_question(user_question)
 
-    classification = pre_filter_question(user_question)
-    if classification:
-        return jsonify({"sql_query": "N/A (Query Rejected)", "results": {"error": classification['message']}, "conversation_id": conversation_id})
+    def answer(sql_query, notice=None):
+        if stream:
+            response = stream_sql_response(sql_query, conversation_id, notice=notice)
+        else:
+            results, chart_suggestion = execute_sql(sql_query, with_chart=True)
 
-    if not is_query_relevant(user_question):
-        response = {"sql_query": "N/A (Query Rejected)", "results": {"error": "I'm sorry, that question does not seem to be related to the available sales, product, or customer data."}, "conversation_id": conversation_id}
-        return jsonify(response)
+        remember_history(history_key, user_question, sql_query)
 
-    raw_sql = generate_sql(user_question, conversation_history)
-    if not raw_sql:
-        return jsonify({"sql_query": "N/A", "results": {"error": "The AI model could not generate a query."}, "conversation_id": conversation_id}), 500
+        if stream:
+            return response
+        response = {"sql_query": sql_query, "results": results, "chart_suggestion": chart_suggestion, "conversation_id": conversation_id}
+        if notice:
+            response["notice"] = notice
+        return format_response(response, fmt)
 
-    sql_to_execute = None
-    try:
-        cleaned_sql = clean_and_validate_sql(raw_sql)
-        sql_to_execute = cleaned_sql
-        results = execute_sql(cleaned_sql)
-        
-        if redis_client:
-            new_history_item = json.dumps({"user_question": user_question, "sql_query": cleaned_sql})
-            redis_client.lpush(history_key, new_history_item)
-            redis_client.expire(history_key, 3600)
-
-        chart_suggestion = analyze_and_suggest_chart(results)
-        response = {"sql_query": cleaned_sql, "results": results, "chart_suggestion": chart_suggestion, "conversation_id": conversation_id}
-        return jsonify(response)
-
-    except ProgrammingError as e:
-        print(f"Initial SQL failed. Attempting self-healing. Error: {e}")
-        corrected_sql_raw = generate_corrected_sql(user_question, sql_to_execute, str(e))
-        
-        if corrected_sql_raw:
-            try:
-                cleaned_corrected_sql = clean_and_validate_sql(corrected_sql_raw)
-                results = execute_sql(cleaned_corrected_sql)
-                
-                print("Self-healing successful!")
-                if redis_client:
-                    new_history_item = json.dumps({"user_question": user_question, "sql_query": cleaned_corrected_sql})
-                    redis_client.lpush(history_key, new_history_item)
-                    redis_client.expire(history_key, 3600)
-
-                chart_suggestion = analyze_and_suggest_chart(results)
-                response = {"sql_query": cleaned_corrected_sql, "results": results, "chart_suggestion": chart_suggestion, "conversation_id": conversation_id, "notice": "The initial query was automatically corrected."}
-                return jsonify(response)
-            except Exception as final_e:
-                print(f"Self-healing failed. Final error: {final_e}")
-                error_explanation = diagnose_sql_error(user_question, corrected_sql_raw, str(final_e))
-                return jsonify({"sql_query": corrected_sql_raw, "results": {"error": error_explanation}, "conversation_id": conversation_id})
+    response, status = run_steps(query_steps(user_question, conversation_history, cache_question), dict(SYNC_IO, answer=answer))
+    if status is None:
+        return response
+    return jsonify(dict(response, conversation_id=conversation_id)), status
+
+# --- BATCH QUERIES ---
+# POST /query/batch answers a list of questions (e.g. a scheduled report) in one request that
+# counts once against the rate limits. Questions are pre-filtered and deduplicated by their
+# cache question; at most BATCH_LLM_CONCURRENCY of them are planned at a time, and the
+# queries then run one after another over a single database connection.
+BATCH_MAX_QUESTIONS = int(os.getenv('BATCH_MAX_QUESTIONS', 200))
+BATCH_LLM_CONCURRENCY = int(os.getenv('BATCH_LLM_CONCURRENCY', 4))
+
+def answer_batch_question(user_question, raw_sql, connection, cache_question=None):
+    """What /query returns for one planned question, with the same self-healing and
+    over-budget fallbacks, run on the batch's `connection`."""
+    def answer(sql_query, notice=None):
+        results, chart_suggestion = execute_sql(sql_query, connection, with_chart=True)
+        response = {"sql_query": sql_query, "results": results, "chart_suggestion": chart_suggestion}
+        if notice:
+            response["notice"] = notice
+        return response
+
+    return run_steps(answer_steps(user_question, raw_sql, cache_question), dict(SYNC_IO, answer=answer))[0]
+
+def run_batch(groups):
+    """Answers each {cache_question: user_question}; returns {cache_question: answer}."""
+    # Each plan runs in a copy of this context so it shares the request's Redis layer.
+    with ThreadPoolExecutor(max_workers=BATCH_LLM_CONCURRENCY, thread_name_prefix='batch') as pool:
+        futures = {cache_question: pool.submit(contextvars.copy_context().run, plan_query, user_question, None, cache_question)
+                   for cache_question, user_question in groups.items()}
+        plans = {cache_question: future.result() for cache_question, future in futures.items()}
+
+    answers, runnable = {}, []
+    for cache_question, (relevant, raw_sql) in plans.items():
+        error = plan_error(relevant, raw_sql)
+        if error:
+            answers[cache_question] = error[0]
         else:
-            error_explanation = diagnose_sql_error(user_question, sql_to_execute, str(e))
-            return jsonify({"sql_query": sql_to_execute, "results": {"error": error_explanation}, "conversation_id": conversation_id})
+            runnable.append(cache_question)
+    if not runnable:
+        return answers
+    try:
+        acquire_db_slot()
+    except DatabaseBusy as e:
+        answers.update((cache_question, {"sql_query": plans[cache_question][1], "results": {"error": str(e)}}) for cache_question in runnable)
+        return answers
+    try:
+        with db_connect() as connection:
+            for cache_question in runnable:
+                answers[cache_question] = answer_batch_question(groups[cache_question], plans[cache_question][1], connection, cache_question)
+    finally:
+        db_slots.release()
+    return answers
 
-#for any errors above.
-    except ValueError as e:
-        return jsonify({"sql_query": raw_sql, "results": {"error": str(e)}, "conversation_id": conversation_id})
+@app.route('/query/batch', methods=['POST'])
+def handle_batch_query():
+    data = request.json or {}
+    questions = data.get('questions')
+    if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+        return jsonify({"error": "'questions' must be a list of strings."}), 400
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return jsonify({"error": f"A batch can hold at most {BATCH_MAX_QUESTIONS} questions."}), 400
 
-#for any unexpected errors.   
-    except Exception as e:
-        print(f"Generic execution error: {e}")
-        error_message = f"A database error occurred: {e}"
-        return jsonify({"sql_query": sql_to_execute or raw_sql, "results": {"error": error_message}, "conversation_id": conversation_id}), 500
+    # The whole batch counts once against the global limits, checked before any per-question
+    # work; the same round trip fetches the cached relevance verdicts and SQL of every
+    # distinct question (near-duplicates matched afterwards are read when needed).
+    if redis_client:
+        try:
+            pipe = redis_client.pipeline()
+            for window in ('minute', 'day'):
+                pipe.incr(RATE_LIMITS[window]['key'])
+                pipe.expire(RATE_LIMITS[window]['key'], RATE_LIMITS[window]['expire'], nx=True)
+            canonicals = dict.fromkeys(canonicalize_question(q) for q in questions if q.strip())
+            prefetch = [key for canonical in canonicals for key in (f"relevance:{canonical}", f"sql:{canonical}")]
+            results = request_redis().read(prefetch, pipe)
+            rate_limit_error = check_rate_limits(results[0], results[2])
+            if rate_limit_error:
+                return jsonify({"error": rate_limit_error}), 429
+        except redis.RedisError as e:
+            print(f"CRITICAL: Redis error during rate limiting: {e}")
+            return jsonify({"error": "Could not contact rate limiting service. Please try again later."}), 503
+
+    items, cache_questions = [None] * len(questions), [None] * len(questions)
+    for i, question in enumerate(questions):
+        user_question = question.strip()
+        if not user_question:
+            items[i] = {"sql_query": "N/A", "results": {"error": "Please enter a question."}}
+            continue
+        classification = pre_filter_question(user_question)
+        if classification:
+            items[i] = {"sql_query": "N/A (Query Rejected)", "results": {"error": classification['message']}}
+            continue
+        cache_questions[i] = find_cache_question(user_question)
+    groups = OrderedDict()
+    for i, cache_question in enumerate(cache_questions):
+        if cache_question and cache_question not in groups:
+            groups[cache_question] = questions[i].strip()
+
+    record_stat('batch_requests')
+    record_stat('batch_questions', len(questions))
+    record_stat('batch_duplicates', sum(1 for q in cache_questions if q) - len(groups))
+    answers = run_batch(groups)
+    return jsonify({"results": [
+        dict({"question": question}, **(item or answers[cache_question]))
+        for question, item, cache_question in zip(questions, items, cache_questions)
+    ]})
+
+@app.cli.command('bump-table-version')
+@click.argument('tables', nargs=-1, required=True)
+def bump_table_version_command(tables):
+    """Invalidates cached results that read TABLES (run after loading new data)."""
+    unknown = set(tables) - set(schema_catalog().columns)
+    if unknown:
+        raise click.BadParameter(f"Unknown table(s): {', '.join(sorted(unknown))}")
+    bump_table_versions(*tables)
+    print(f"Bumped table version for: {', '.join(tables)}")
+    if ROLLUP_REWRITE and set(tables) & set(ROLLUP_SOURCE_TABLES) and inspect(engine).has_table('rollup_state'):
+        refresh_rollups()
+
+@app.cli.command('refresh-rollups')
+@click.option('--rebuild', is_flag=True, help="Re-aggregate every day, not just the days with new sales rows.")
+def refresh_rollups_command(rebuild):
+    """Brings the sales rollup tables up to date (creating them on first use)."""
+    refresh_rollups(rebuild)
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,677 @@
+# asgi.py
+# Async version of the /query pipeline, for serving under an ASGI worker:
+#
+#   gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+#
+# Model calls (azure.ai.inference.aio), Redis (redis.asyncio) and MySQL (aiomysql)
+# are all awaited, so one process can hold hundreds of in-flight questions instead of
+# one per sync worker. The pipeline itself (app.query_steps), prompts, validation, caching
+# formats and chart logic are shared with app.py; only the I/O is async here. Every other
+# route is served by the Flask app through WsgiToAsgi.
+import os
+import json
+import time
+import uuid
+import asyncio
+import redis
+import redis.asyncio as aioredis
+from asgiref.wsgi import WsgiToAsgi
+from azure.ai.inference.aio import ChatCompletionsClient as AsyncChatCompletionsClient
+from azure.core.credentials import AzureKeyCredential
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError, ProgrammingError, OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as core
+
+
+# --- SETUP ---
+redis_client = None
+if core.redis_client:
+    redis_client = aioredis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', 6379)),
+        db=0,
+        decode_responses=True,
+        socket_timeout=5
+    )
+
+# The async client opens its HTTP session on the worker's event loop, so it is created at startup.
+client = None
+
+async_db_url = os.getenv("ASYNC_DATABASE_URL", core.db_url.replace("+mysqlconnector", "+aiomysql"))
+async_engine = create_async_engine(
+    async_db_url,
+    pool_size=5,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_recycle=1800,
+    pool_pre_ping=True
+)
+if async_engine.dialect.name == 'mysql' and core.QUERY_TIMEOUT_MS:
+    event.listen(async_engine.sync_engine, 'connect', core.set_session_limits)
+# Per-worker limit on simultaneous queries, as in app.py (created lazily on the worker's loop).
+db_slots = None
+
+@asynccontextmanager
+async def lifespan(_app):
+    global client
+    core.start_invalidation_listener()
+    client = AsyncChatCompletionsClient(
+        endpoint=os.getenv("AZURE_AI_ENDPOINT"),
+        credential=AzureKeyCredential(os.getenv("AI_TOKEN")),
+    )
+    try:
+        yield
+    finally:
+        await client.close()
+        if redis_client:
+            await redis_client.aclose()
+        await async_engine.dispose()
+
+def json_response(content, status_code=200):
+    # Flask's JSON provider, so responses are byte-for-byte those of the sync path.
+    return Response(core.app.json.dumps(content) + "\n", status_code=status_code, media_type="application/json")
+
+def format_response(response_data, fmt, accept_encoding):
+    if fmt == 'records':
+        return json_response(response_data)
+    try:
+        body, mimetype, headers = core.render_results(response_data, fmt, accept_encoding)
+    except ImportError:
+        return json_response({"sql_query": response_data['sql_query'], "results": {"error": "Arrow output is not available on this server (pyarrow is not installed)."}, "conversation_id": response_data['conversation_id']}, 406)
+    return Response(body, media_type=mimetype, headers=headers)
+
+# --- CACHE ---
+# The worker's L1 cache (app.local_cache) sits in front of Redis here too.
+async def get_cached_response(cache_key):
+    if not redis_client: return None
+    try:
+        value = core.local_cache.get(cache_key)
+        if value is not core.MISSING:
+            core.record_stat('cache_l1_hit')
+            return value
+        generation = core.local_cache.generation
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(cache_key)
+        pipe.pttl(cache_key)
+        cached_data, ttl = await pipe.execute()
+        if cached_data:
+            value = json.loads(cached_data)
+            core.local_cache.set(cache_key, value, ttl / 1000 if ttl > 0 else None, generation)
+            core.record_stat('cache_l2_hit')
+            return value
+        core.record_stat('cache_miss')
+    except Exception as e:
+        print(f"Cache error: {e}")
+    return None
+
+async def cache_response(cache_key, response_data, ttl=3600):
+    if not redis_client: return
+    try:
+        payload = json.dumps(response_data, default=str)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.setex(cache_key, ttl, payload)
+        pipe.publish(core.CACHE_INVALIDATION_CHANNEL, core.invalidation_message(cache_key))
+        await pipe.execute()
+        core.local_cache.set(cache_key, json.loads(payload), ttl)
+    except Exception as e:
+        print(f"Cache error: {e}")
+
+async def find_cache_question(user_question):
+    since = core.question_index_due() if redis_client else None
+    if since is not None:
+        try:
+            core.load_recent_questions(await redis_client.zrangebyscore(core.SIMILARITY_INDEX_KEY, since, '+inf', withscores=True))
+        except Exception as e:
+            print(f"Cache error: {e}")
+    return core.match_cache_question(user_question)
+
+async def store_generated_sql(cache_question, sql):
+    await cache_response(f"sql:{cache_question}", sql, ttl=core.SQL_CACHE_TTL)
+    core.question_index.add(cache_question)
+    if not redis_client: return
+    try:
+        pipe = redis_client.pipeline()
+        for name, args, kwargs in core.question_index_writes(cache_question):
+            getattr(pipe, name)(*args, **kwargs)
+        await pipe.execute()
+    except Exception as e:
+        print(f"Cache error: {e}")
+
+async def get_cached_result_set(sql_query):
+    cached = await get_cached_result_entry(sql_query)
+    return cached[0] if cached else None
+
+async def get_cached_result_entry(sql_query):
+    """(results, chart suggestion) from the result-set cache, or None (see app.get_cached_result_entry)."""
+    if not redis_client: return None
+    try:
+        entry = await get_cached_response(f"result:{core.sql_fingerprint(sql_query)}")
+        if entry:
+            tables = list(entry["versions"])
+            versions = await redis_client.mget([f"table_version:{t}" for t in tables]) if tables else []
+            if {t: int(v or 0) for t, v in zip(tables, versions)} == entry["versions"]:
+                core.record_stat('result_cache_hit')
+                return await run_in_threadpool(core.cached_result_value, entry)
+    except Exception as e:
+        print(f"Cache error: {e}")
+    core.record_stat('result_cache_miss')
+    return None
+
+async def cache_result_set(sql_query, results, chart_suggestion=None):
+    ttl = core.result_cache_ttl(sql_query)
+    if not redis_client or ttl <= 0: return
+    try:
+        tables = core.referenced_tables(sql_query)
+        versions = await redis_client.mget([f"table_version:{t}" for t in tables]) if tables else []
+        entry = {"versions": {t: int(v or 0) for t, v in zip(tables, versions)}, "result": core.encode_result_set(results), "chart": chart_suggestion}
+    except Exception as e:
+        print(f"Cache error: {e}")
+        return
+    await cache_response(f"result:{core.sql_fingerprint(sql_query)}", entry, ttl=ttl)
+
+async def rollup_sql(sql_query):
+    """Same routing as app.rollup_sql()."""
+    if not core.ROLLUP_REWRITE or not redis_client or 'sales' not in core.referenced_tables(sql_query):
+        return sql_query
+    try:
+        state, *versions = await redis_client.mget(core.rollup_keys(['sales']))
+        versions = {t: int(v or 0) for t, v in zip(core.ROLLUP_SOURCE_TABLES, versions)}
+    except Exception as e:
+        print(f"Cache error: {e}")
+        return sql_query
+    return core.route_to_rollups(sql_query, json.loads(state) if state else None, versions)
+
+# --- SINGLE-FLIGHT ---
+# app.py's single-flight (see its SINGLE-FLIGHT section) for coroutines: callers in this
+# worker share one Future, and the Redis lock and result keys are the same, so async and
+# sync workers coalesce with each other.
+class FlightWaiter(asyncio.Event):
+    """An Event the invalidation listener thread can set (it calls wake_flight_waiter)."""
+    def __init__(self):
+        super().__init__()
+        self.loop = asyncio.get_running_loop()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(super().set)
+
+flights = {}
+
+async def single_flight(key, compute, saves='llm_calls'):
+    """Same as app.single_flight(), with `compute` a coroutine function."""
+    flight = flights.get(key)
+    if flight is not None:
+        try:
+            value = await asyncio.wait_for(asyncio.shield(flight), core.FLIGHT_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            core.record_stat('flight_timeout')
+            return await compute()
+        if value is core.MISSING:
+            core.record_stat('flight_leader_failed')
+            return await compute()
+        core.record_stat('flight_follower')
+        core.record_stat(f"{saves}_saved")
+        return value
+    flight = flights[key] = asyncio.get_running_loop().create_future()
+    value = core.MISSING
+    try:
+        value = await lead_flight(key, compute, saves)
+        return value
+    finally:
+        flights.pop(key, None)
+        flight.set_result(value)
+
+async def lead_flight(key, compute, saves):
+    if not redis_client:
+        return await compute()
+    lock_key, token = f"flight:lock:{key}", uuid.uuid4().hex
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(lock_key, token, nx=True, px=core.FLIGHT_LOCK_SECONDS * 1000)
+            pipe.get(lock_key)
+            acquired, holder = await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Cache error: {e}")
+        return await compute()
+    if not acquired and holder:
+        entry = await wait_for_flight(f"flight:result:{key}:{holder}")
+        if entry and 'value' in entry:
+            core.record_stat('flight_follower')
+            core.record_stat(f"{saves}_saved")
+            return entry['value']
+        core.record_stat('flight_timeout' if entry is None else 'flight_leader_failed')
+        return await compute()
+    core.record_stat('flight_leader')
+    entry = {"failed": True}
+    try:
+        entry = {"value": await compute()}
+        return entry['value']
+    finally:
+        result_key = f"flight:result:{key}:{token}"
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.setex(result_key, core.FLIGHT_RESULT_TTL, json.dumps(entry, default=str))
+                pipe.publish(core.CACHE_INVALIDATION_CHANNEL, core.invalidation_message(result_key))
+                pipe.delete(lock_key)
+                await pipe.execute()
+        except redis.RedisError as e:
+            print(f"Cache error: {e}")
+
+async def wait_for_flight(result_key):
+    """The leader's result entry, or None if it didn't arrive within FLIGHT_WAIT_SECONDS."""
+    event = FlightWaiter()
+    with core.flights_lock:
+        core.flight_waiters[result_key] = event
+    deadline = time.monotonic() + core.FLIGHT_WAIT_SECONDS
+    try:
+        while True:
+            payload = await redis_client.get(result_key)
+            if payload:
+                return json.loads(payload)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(event.wait(), min(core.FLIGHT_POLL_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+    except redis.RedisError as e:
+        print(f"Cache error: {e}")
+        return None
+    finally:
+        with core.flights_lock:
+            core.flight_waiters.pop(result_key, None)
+
+# --- MODEL CALLS ---
+async def complete(call, request_kwargs):
+    start, response = time.perf_counter(), None
+    try:
+        response = await client.complete(**request_kwargs)
+        return response.choices[0].message.content
+    finally:
+        core.record_llm_usage(call, response, time.perf_counter() - start)
+
+async def is_query_relevant(user_question, cache_question):
+    cache_key = f"relevance:{cache_question}"
+    cached_result = await get_cached_response(cache_key)
+    if cached_result is not None:
+        core.record_stat('relevance_cache_hit')
+        return cached_result
+    core.record_stat('relevance_cache_miss')
+    return await single_flight(cache_key, lambda: check_relevance(user_question, cache_key))
+
+async def check_relevance(user_question, cache_key):
+    try:
+        result = "YES" in (await complete('relevance', core.relevance_request(user_question))).strip().upper()
+        await cache_response(cache_key, result)
+        return result
+    except Exception as e:
+        print(f"Error in is_query_relevant: {e}")
+        return None
+
+async def generate_sql(user_question, conversation_history, cache_question, store=True):
+    if not conversation_history:
+        cached_sql = await get_cached_response(f"sql:{cache_question}")
+        if cached_sql:
+            core.record_stat('sql_cache_hit')
+            return cached_sql
+        core.record_stat('sql_cache_miss')
+        return await single_flight(f"sql:{cache_question}", lambda: write_sql(user_question, None, cache_question if store else None))
+    return await write_sql(user_question, conversation_history)
+
+async def write_sql(user_question, conversation_history=None, cache_question=None):
+    try:
+        sql = await complete('sql', core.sql_request(user_question, conversation_history))
+        if cache_question:
+            await store_generated_sql(cache_question, sql)
+        return sql
+    except Exception as e:
+        print(f"Error in generate_sql: {e}")
+        return None
+
+async def merged_relevance_and_sql(user_question, conversation_history, cache_question):
+    if conversation_history:
+        return tuple(await generate_relevance_and_sql(user_question, conversation_history))
+    return tuple(await single_flight(f"merged:{cache_question}", lambda: generate_relevance_and_sql(user_question)))
+
+async def generate_relevance_and_sql(user_question, conversation_history=None):
+    try:
+        return list(core.parse_merged_answer(await complete('merged', core.merged_request(user_question, conversation_history))))
+    except Exception as e:
+        print(f"Error in generate_relevance_and_sql: {e}")
+        return [None, None]
+
+async def parallel_relevance_and_sql(user_question, conversation_history, cache_question):
+    """SQL generation runs as a task next to the relevance check."""
+    sql_task = asyncio.ensure_future(generate_sql(user_question, conversation_history, cache_question, store=False))
+    relevant = await is_query_relevant(user_question, cache_question)
+    if relevant:
+        return relevant, await sql_task
+    sql_task.cancel()
+    return relevant, None
+
+async def remember_correction(error_key, corrected_sql, cache_question=None):
+    """Same as app.remember_correction()."""
+    await cache_response(f"correction:{error_key}", corrected_sql, ttl=core.CORRECTION_CACHE_TTL)
+    if cache_question:
+        await store_generated_sql(cache_question, corrected_sql)
+
+async def forget_correction(error_key):
+    if not redis_client: return
+    try:
+        await redis_client.delete(f"correction:{error_key}")
+    except Exception as e:
+        print(f"Cache error: {e}")
+
+async def generate_corrected_sql(user_question, original_sql, error_message, error_key=None):
+    if error_key:
+        cached_sql = await get_cached_response(f"correction:{error_key}")
+        if cached_sql:
+            core.record_stat('correction_cache_hit')
+            return cached_sql
+        core.record_stat('correction_cache_miss')
+        return await single_flight(f"correction:{error_key}", lambda: request_correction(user_question, original_sql, error_message))
+    return await request_correction(user_question, original_sql, error_message)
+
+async def request_correction(user_question, original_sql, error_message):
+    try:
+        return await complete('correction', core.correction_request(user_question, original_sql, error_message))
+    except Exception as e:
+        print(f"Error in generate_corrected_sql: {e}")
+        return None
+
+async def generate_cheaper_sql(user_question, sql_query, estimated_rows):
+    try:
+        return await complete('rewrite', core.rewrite_request(user_question, sql_query, estimated_rows))
+    except Exception as e:
+        print(f"Error in generate_cheaper_sql: {e}")
+        return None
+
+async def diagnose_sql_error(user_question, sql_query, error_message, error_key=None):
+    if error_key:
+        cached_diagnosis = await get_cached_response(f"diagnosis:{error_key}")
+        if cached_diagnosis:
+            core.record_stat('diagnosis_cache_hit')
+            return cached_diagnosis
+        core.record_stat('diagnosis_cache_miss')
+    try:
+        diagnosis = await complete('diagnosis', core.diagnosis_request(user_question, sql_query, error_message))
+        if error_key:
+            await cache_response(f"diagnosis:{error_key}", diagnosis, ttl=core.CORRECTION_CACHE_TTL)
+        return diagnosis
+    except Exception as e:
+        print(f"Error in diagnose_sql_error: {e}")
+        return core.DIAGNOSIS_FALLBACK
+
+# --- QUERY PIPELINE ---
+# app.py's steps (see its QUERY PIPELINE section), with each operation awaited; CPU-bound
+# ones (validation, result shaping, charts, rendering) run in the thread pool.
+async def run_steps(steps, io):
+    value = error = None
+    while True:
+        try:
+            name, *args = steps.throw(error) if error else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value = error = None
+        try:
+            value = await io[name](*args)
+        except Exception as e:
+            error = e
+
+async def validate_sql(sql_string):
+    return await run_in_threadpool(core.clean_and_validate_sql, sql_string)
+
+ASYNC_IO = {
+    'cached': get_cached_response,
+    'cache': cache_response,
+    'relevance': is_query_relevant,
+    'sql': generate_sql,
+    'merged': merged_relevance_and_sql,
+    'parallel': parallel_relevance_and_sql,
+    'store_sql': store_generated_sql,
+    'validate': validate_sql,
+    'correct': generate_corrected_sql,
+    'remember_correction': remember_correction,
+    'forget_correction': forget_correction,
+    'diagnose': diagnose_sql_error,
+    'cheaper': generate_cheaper_sql,
+}
+
+# --- DATABASE ---
+async def explain_sql(connection, sql_query):
+    try:
+        plan = (await connection.execute(text(f"EXPLAIN {sql_query}"))).mappings().all()
+    except (ProgrammingError, OperationalError) as e:
+        if core.SQL_VALIDATION_MODE != 'server':
+            raise
+        raise core.InvalidSQL(sql_query, e, core.mysql_errno(e)) from e
+    core.mark_validated(sql_query)
+    return plan
+
+async def admit_query(connection, sql_query):
+    """Same admission check as app.admit_query()."""
+    if async_engine.dialect.name != 'mysql':
+        if core.SQL_VALIDATION_MODE == 'server' and not core.is_validated(sql_query):
+            await explain_sql(connection, sql_query)
+        return
+    estimated_rows = core.estimate_examined_rows(await explain_sql(connection, sql_query))
+    if estimated_rows > core.QUERY_MAX_ESTIMATED_ROWS:
+        core.record_stat('query_over_budget')
+        raise core.QueryTooExpensive(estimated_rows)
+
+async def acquire_db_slot():
+    global db_slots
+    if db_slots is None:
+        db_slots = asyncio.BoundedSemaphore(core.DB_MAX_CONCURRENT_QUERIES)
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(db_slots.acquire(), core.DB_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        core.record_stat('db_queue_timeout')
+        raise core.DatabaseBusy("The database is busy right now. Please try again in a moment.")
+    finally:
+        core.observe_stage('db_queue_wait', time.perf_counter() - start)
+
+async def execute_sql(sql_query):
+    """(results, chart suggestion), as app.execute_sql(with_chart=True)."""
+    cached = await get_cached_result_entry(sql_query)
+    if cached is not None:
+        return cached
+    computed = {}
+    async def run():
+        computed['results'], computed['chart'] = await run_sql(sql_query)
+        return {"result": core.encode_result_set(computed['results']), "chart": computed['chart']}
+    shared = await single_flight(f"result:{core.sql_fingerprint(sql_query)}", run, saves='db_queries')
+    if 'results' in computed:
+        return computed['results'], computed['chart']
+    return await run_in_threadpool(core.cached_result_value, shared)
+
+async def run_sql(sql_query):
+    query = await rollup_sql(sql_query)
+    await acquire_db_slot()
+    try:
+        async with async_engine.connect() as connection:
+            async with connection.begin():
+                await admit_query(connection, query)
+                result = await connection.execute(text(query))
+                columns, rows = list(result.keys()), result.all()
+    except ValueError:
+        raise
+    except DBAPIError as e:
+        if core.mysql_errno(e) == core.MYSQL_QUERY_TIMEOUT_ERRNO:
+            core.record_stat('query_timeout')
+            raise core.QueryTimedOut() from e
+        print(f"Error executing SQL: {e}")
+        raise
+    except Exception as e:
+        print(f"Error executing SQL: {e}")
+        raise
+    finally:
+        db_slots.release()
+    results, chart_suggestion = await run_in_threadpool(core.shape_rows, columns, rows)
+    await cache_result_set(sql_query, results, chart_suggestion)
+    return results, chart_suggestion
+
+async def stream_sql_response(sql_query, conversation_id, notice=None):
+    """NDJSON records in the same shape as app.stream_sql_response()."""
+    cached_results = await get_cached_result_set(sql_query)
+    connection = result = None
+    if cached_results is not None:
+        columns = list(cached_results[0].keys()) if cached_results else []
+        rows = [tuple(record.values()) for record in cached_results]
+        pending = [rows[i:i + core.STREAM_CHUNK_SIZE] for i in range(0, len(rows), core.STREAM_CHUNK_SIZE)]
+        first = pending.pop(0) if pending else []
+    else:
+        query = await rollup_sql(sql_query)
+        await acquire_db_slot()
+        try:
+            connection = await async_engine.connect()
+            await connection.begin()
+            await admit_query(connection, query)
+            result = await connection.stream(text(query))
+            columns = list(result.keys())
+            first = await result.fetchmany(core.STREAM_CHUNK_SIZE)
+        except Exception as e:
+            if connection is not None:
+                await connection.close()
+            db_slots.release()
+            if isinstance(e, DBAPIError) and core.mysql_errno(e) == core.MYSQL_QUERY_TIMEOUT_ERRNO:
+                core.record_stat('query_timeout')
+                raise core.QueryTimedOut() from e
+            raise
+
+    async def close():
+        """Returns the connection and the query slot; safe to call more than once."""
+        nonlocal connection, result
+        if result is not None:
+            await result.close()
+            result = None
+        if connection is not None:
+            await connection.close()
+            connection = None
+            db_slots.release()
+
+    async def next_chunk():
+        if result is None:
+            return pending.pop(0) if pending else []
+        return await result.fetchmany(core.STREAM_CHUNK_SIZE)
+
+    async def generate():
+        header = {"type": "header", "sql_query": sql_query, "conversation_id": conversation_id, "columns": columns}
+        if notice:
+            header["notice"] = notice
+        yield core.app.json.dumps(header) + "\n"
+        row_count, chart_suggestion = 0, None
+        try:
+            chunk = first
+            while chunk:
+                records = [dict(zip(columns, row)) for row in chunk]
+                if row_count == 0:
+                    chart_suggestion = await run_in_threadpool(core.analyze_and_suggest_chart, records, False)
+                row_count += len(records)
+                yield core.app.json.dumps({"type": "rows", "rows": records}) + "\n"
+                chunk = await next_chunk()
+        except Exception as e:
+            print(f"Error streaming SQL results: {e}")
+            yield core.app.json.dumps({"type": "error", "error": f"A database error occurred: {e}"}) + "\n"
+            return
+        finally:
+            await close()
+        yield core.app.json.dumps({"type": "trailer", "row_count": row_count, "chart_suggestion": chart_suggestion}) + "\n"
+
+    # The background task also releases the connection if the client disconnects early.
+    return StreamingResponse(generate(), media_type='application/x-ndjson', headers={'X-Accel-Buffering': 'no'}, background=BackgroundTask(close))
+
+# --- ROUTES ---
+async def remember_history(history_key, user_question, sql_query):
+    if not redis_client: return
+    pipe = redis_client.pipeline()
+    pipe.lpush(history_key, json.dumps({"user_question": user_question, "sql_query": sql_query}))
+    pipe.ltrim(history_key, 0, core.HISTORY_LENGTH - 1)
+    pipe.expire(history_key, 3600)
+    await pipe.execute()
+
+async def handle_query(request):
+    """/query, timed like the Flask app's requests (Server-Timing header and REQUEST_SECONDS)."""
+    start, timings = time.perf_counter(), defaultdict(float)
+    core.request_timings.set(timings)
+    response = await answer_query(request)
+    total = time.perf_counter() - start
+    core.REQUEST_SECONDS.labels('handle_query', response.status_code).observe(total)
+    response.headers['Server-Timing'] = core.server_timing(timings, total)
+    return response
+
+async def answer_query(request):
+    # --- GLOBAL RATE LIMITING (same counters as the sync path) ---
+    if redis_client:
+        try:
+            pipe = redis_client.pipeline()
+            minute_key = core.RATE_LIMITS['minute']['key']
+            pipe.incr(minute_key)
+            pipe.expire(minute_key, core.RATE_LIMITS['minute']['expire'], nx=True)
+            day_key = core.RATE_LIMITS['day']['key']
+            pipe.incr(day_key)
+            pipe.expire(day_key, core.RATE_LIMITS['day']['expire'], nx=True)
+            results = await pipe.execute()
+            rate_limit_error = core.check_rate_limits(results[0], results[2])
+            if rate_limit_error:
+                return json_response({"sql_query": "N/A", "results": {"error": rate_limit_error}}, 429)
+        except redis.RedisError as e:
+            print(f"CRITICAL: Redis error during rate limiting: {e}")
+            return json_response({"sql_query": "N/A", "results": {"error": "Could not contact rate limiting service. Please try again later."}}, 503)
+
+    data = await request.json()
+    user_question = data.get('question', '').strip()
+    conversation_id = data.get('conversation_id')
+    stream = bool(data.get('stream')) or 'application/x-ndjson' in request.headers.get('accept', '')
+    fmt = core.requested_format(data, request.headers)
+
+    if not user_question:
+        return json_response({"sql_query": "N/A", "results": {"error": "Please enter a question."}})
+
+    if not conversation_id:
+        conversation_id = str(uuid.uuid4())
+
+    conversation_history = []
+    history_key = f"history:{conversation_id}"
+    if redis_client:
+        raw_history = await redis_client.lrange(history_key, 0, core.HISTORY_LENGTH - 1)
+        conversation_history = [json.loads(item) for item in reversed(raw_history)]
+
+    cache_question = await find_cache_question(user_question)
+
+    async def answer(sql_query, notice=None):
+        if stream:
+            response = await stream_sql_response(sql_query, conversation_id, notice)
+        else:
+            results, chart_suggestion = await execute_sql(sql_query)
+            response = {"sql_query": sql_query, "results": results, "chart_suggestion": chart_suggestion, "conversation_id": conversation_id}
+            if notice:
+                response["notice"] = notice
+            response = await run_in_threadpool(format_response, response, fmt, request.headers.get('accept-encoding', ''))
+        await remember_history(history_key, user_question, sql_query)
+        return response
+
+    steps = core.query_steps(user_question, conversation_history, cache_question, latency_prefix='async:')
+    response, status = await run_steps(steps, dict(ASYNC_IO, answer=answer))
+    if status is None:
+        return response
+    return json_response(dict(response, conversation_id=conversation_id), status)
+
+app = Starlette(
+    routes=[
+        Route('/query', handle_query, methods=['POST']),
+        Mount('/', app=WsgiToAsgi(core.app)),
+    ],
+    lifespan=lifespan,
+)
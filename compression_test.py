@@ -0,0 +1,22 @@
+import app
+
+BODY = b'{"results": []}' * 1000
+
+def encoding(accept_encoding):
+    return app.compress_body(BODY, accept_encoding)[1]
+
+def test_refused_encodings_are_not_used():
+    assert encoding("br;q=0, gzip") == "gzip"
+    assert encoding("gzip;q=0, br;q=0") is None
+    assert encoding("*;q=0") is None
+    assert encoding("identity") is None
+
+def test_client_preference_wins():
+    assert encoding("gzip, deflate, br") == "br"
+    assert encoding("gzip;q=1.0, br;q=0.5") == "gzip"
+    assert encoding("*") == "br"
+
+if __name__ == "__main__":
+    test_refused_encodings_are_not_used()
+    test_client_preference_wins()
+    print("Responses are compressed only with encodings the client accepts.")
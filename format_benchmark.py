@@ -0,0 +1,81 @@
+import argparse
+import gzip
+import os
+import random
+import statistics
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+# app.py builds its model client at import time; the benchmark never calls the model.
+os.environ.setdefault("AI_TOKEN", "benchmark")
+os.environ.setdefault("AZURE_AI_ENDPOINT", "https://benchmark.invalid")
+
+import app
+
+CATEGORIES = ["Electronics", "Furniture", "Office", "Garden", "Toys"]
+
+def synthetic_rows(count, seed=42):
+    """Rows shaped like a sales x products x customers join."""
+    rng = random.Random(seed)
+    start = date(2023, 1, 1)
+    return [
+        {
+            "sale_id": i,
+            "sale_date": start + timedelta(days=rng.randrange(730)),
+            "customer": f"Customer {rng.randrange(5000)}",
+            "product": f"Product {rng.randrange(800)}",
+            "category": rng.choice(CATEGORIES),
+            "price": Decimal(rng.randrange(100, 200000)) / 100,
+            "quantity": rng.randrange(1, 20),
+        }
+        for i in range(1, count + 1)
+    ]
+
+def database_rows(sql):
+    app.redis_client = None   # measure the database result, not the cache
+    return app.execute_sql(sql)
+
+def timed(fn, runs):
+    timings, result = [], None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, statistics.median(timings)
+
+def run_format_benchmark():
+    parser = argparse.ArgumentParser(description="Payload size and serialization time per response format.")
+    parser.add_argument("--rows", type=int, default=1000, help="synthetic row count")
+    parser.add_argument("--sql", help="benchmark the rows of this query on DATABASE_URL instead")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    results = database_rows(args.sql) if args.sql else synthetic_rows(args.rows)
+    envelope = {"sql_query": args.sql or "SELECT ...", "results": results, "conversation_id": "benchmark"}
+    envelope["chart_suggestion"] = app.analyze_and_suggest_chart(results)
+
+    cases = [
+        ("records (current)", lambda: (app.app.json.dumps(envelope) + "\n").encode("utf-8")),
+        ("records + gzip", lambda: gzip.compress((app.app.json.dumps(envelope) + "\n").encode("utf-8"), compresslevel=6)),
+        ("columnar", lambda: app.render_results(envelope, "columnar")[0]),
+        ("columnar + gzip", lambda: app.render_results(envelope, "columnar", "gzip")[0]),
+        ("columnar + br", lambda: app.render_results(envelope, "columnar", "br")[0]),
+        ("arrow", lambda: app.render_results(envelope, "arrow")[0]),
+    ]
+
+    print(f"{len(results)} rows, median of {args.runs} runs\n")
+    print(f"{'format':<20}{'bytes':>12}{'vs records':>12}{'ms':>10}")
+    baseline = None
+    for name, serialize in cases:
+        try:
+            body, seconds = timed(serialize, args.runs)
+        except ImportError as e:
+            print(f"{name:<20}  skipped ({e.name} not installed)")
+            continue
+        baseline = baseline or len(body)
+        print(f"{name:<20}{len(body):>12}{len(body) / baseline:>11.0%}{seconds * 1000:>10.2f}")
+    print("\n'columnar + br' falls back to gzip or identity when brotli is not installed.")
+
+if __name__ == "__main__":
+    run_format_benchmark()
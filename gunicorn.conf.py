@@ -0,0 +1,16 @@
+# gunicorn.conf.py (read by gunicorn from the working directory)
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+def on_starting(server):
+    # Metric files left over from a previous run would be summed into /metrics.
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
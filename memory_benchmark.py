@@ -0,0 +1,64 @@
+import argparse
+import os
+import statistics
+import time
+import tracemalloc
+
+# app.py builds its model client at import time; the benchmark never calls the model.
+os.environ.setdefault("AI_TOKEN", "benchmark")
+os.environ.setdefault("AZURE_AI_ENDPOINT", "https://benchmark.invalid")
+
+import app
+
+# A wide join that hits the default 1000-row LIMIT.
+DEFAULT_SQL = (
+    "SELECT s.id, s.sale_date, s.quantity, c.name AS customer, c.signup_date, "
+    "p.name AS product, p.category, p.price "
+    "FROM sales s JOIN customers c ON c.id = s.customer_id JOIN products p ON p.id = s.product_id "
+    "LIMIT 1000"
+)
+
+def buffered_path(sql):
+    """The regular /query path: DataFrame -> records -> one JSON document."""
+    results = app.execute_sql(sql)
+    chart_suggestion = app.analyze_and_suggest_chart(results)
+    body = app.jsonify({"sql_query": sql, "results": results, "chart_suggestion": chart_suggestion, "conversation_id": "benchmark"})
+    return len(body.get_data())
+
+def streaming_path(sql):
+    """The streaming path: unbuffered cursor -> NDJSON chunks, consumed as a client would."""
+    response = app.stream_sql_response(sql, "benchmark")
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    return size
+
+def measure(path, sql, runs):
+    peaks, timings, size = [], [], 0
+    for _ in range(runs):
+        tracemalloc.start()
+        start = time.perf_counter()
+        with app.app.test_request_context('/query', method='POST'):
+            size = path(sql)
+        timings.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {"peak_kib": statistics.median(peaks) / 1024, "seconds": statistics.median(timings), "bytes": size}
+
+def run_memory_benchmark():
+    parser = argparse.ArgumentParser(description="Peak Python memory per request: buffered vs streaming results.")
+    parser.add_argument("--sql", default=DEFAULT_SQL)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    # Measure the database path, not the result cache.
+    app.redis_client = None
+
+    print(f"SQL: {args.sql}")
+    print(f"Chunk size: {app.STREAM_CHUNK_SIZE} rows, {args.runs} runs each (median)\n")
+    for name, path in (("buffered", buffered_path), ("streaming", streaming_path)):
+        stats = measure(path, args.sql, args.runs)
+        print(f"{name:>10}: peak {stats['peak_kib']:10.1f} KiB | {stats['seconds'] * 1000:8.1f} ms | {stats['bytes']} bytes sent")
+
+if __name__ == "__main__":
+    run_memory_benchmark()
@@ -0,0 +1,63 @@
+import argparse
+import random
+import re
+import time
+
+import app
+from remote_metrics_test import TEST_QUESTIONS
+
+RULE_COUNTS = (8, 50, 100, 250, 500, 1000)
+
+def synthetic_rules(count, seed=7):
+    """The shipped rules plus generated tenant rules: mostly keyword lists, every fifth one a regex."""
+    rng = random.Random(seed)
+    rules = list(app.CLASSIFICATION_RULES)
+    for i in range(count - len(rules)):
+        words = [f"term{i}x{j}" for j in range(rng.randrange(3, 12))]
+        if i % 5 == 0:
+            rules.append({"status": "off_topic", "pattern": rf"\b(?:{'|'.join(words)})\b", "message": f"rule {i}"})
+        else:
+            rules.append({"status": "off_topic", "keywords": words, "message": f"rule {i}"})
+    return rules
+
+def legacy_classifier(rules):
+    """The previous implementation: one regex per rule, searched in order."""
+    compiled = [
+        (re.compile(rule['pattern'] if 'pattern' in rule else rf"\b({'|'.join(map(re.escape, rule['keywords']))})\b", re.IGNORECASE), rule)
+        for rule in rules
+    ]
+
+    def classify(question):
+        for pattern, rule in compiled:
+            if pattern.search(question):
+                return rule
+        return None
+    return classify
+
+def per_question_us(classify, questions, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for question in questions:
+            classify(question)
+    return (time.perf_counter() - start) / (repeat * len(questions)) * 1e6
+
+def run_prefilter_benchmark():
+    parser = argparse.ArgumentParser(description="Per-question pre-filter time as the rule count grows.")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    # Relevant questions pass every rule, which is the worst case for both matchers.
+    questions = TEST_QUESTIONS + ["hi", "Tell me a joke", "drop table sales", ""]
+    print(f"{'rules':>6}{'legacy µs':>12}{'compiled µs':>14}{'speedup':>10}")
+    for count in RULE_COUNTS:
+        rules = synthetic_rules(count)
+        legacy = legacy_classifier(rules)
+        compiled = app.CompiledRules(rules)
+        for question in questions:
+            assert legacy(question) == compiled.match(question), question
+        legacy_us = per_question_us(legacy, questions, args.repeat)
+        compiled_us = per_question_us(compiled.match, questions, args.repeat)
+        print(f"{count:>6}{legacy_us:>12.1f}{compiled_us:>14.1f}{legacy_us / compiled_us:>9.1f}x")
+
+if __name__ == "__main__":
+    run_prefilter_benchmark()
@@ -0,0 +1,57 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("AI_TOKEN", "test")
+os.environ.setdefault("AZURE_AI_ENDPOINT", "https://example.invalid")
+
+import fakeredis
+
+import app
+
+class SlowPipeline:
+    """Queues commands slowly, widening the window for threads to interleave."""
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def __len__(self):
+        return len(self.pipe)
+
+    def execute(self):
+        return self.pipe.execute()
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            time.sleep(0.0005)
+            return getattr(self.pipe, name)(*args, **kwargs)
+        return command
+
+class SlowClient:
+    def __init__(self, client):
+        self.client = client
+
+    def pipeline(self, **kwargs):
+        return SlowPipeline(self.client.pipeline(**kwargs))
+
+# A request's parallel model calls and batch planners share its RequestRedis.
+def test_threads_share_a_request_layer():
+    client = fakeredis.FakeRedis(decode_responses=True)
+    layer = app.RequestRedis(SlowClient(client))
+
+    def work(worker):
+        for n in range(200):
+            layer.setex(f"test:{worker}:{n}", 60, str(n))
+            assert layer.get(f"test:{worker}:{n}") == str(n)
+            layer.read([f"missing:{worker}:{n}"])
+            if n % 10 == 0:
+                layer.flush()
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(work, range(4)))
+    layer.flush()
+    assert len(client.keys("test:*")) == 800
+    assert not layer.writes and len(layer.values) == 1600
+
+if __name__ == "__main__":
+    test_threads_share_a_request_layer()
+    print("A RequestRedis shared by threads keeps every write.")
@@ -0,0 +1,28 @@
+import fakeredis
+
+import app
+
+# Table versions only say when stored rows go stale through new data; rows that depend on
+# the clock or on random values go stale on their own.
+def cached_ttl(sql_query):
+    app.redis_client = fakeredis.FakeRedis(decode_responses=True)
+    app.cache_result_set(sql_query, [{"total": 1}])
+    return app.redis_client.ttl(f"result:{app.sql_fingerprint(sql_query)}")
+
+def test_clock_queries_are_cached_briefly():
+    for sql_query in ("SELECT SUM(quantity) AS total FROM sales WHERE sale_date >= CURDATE() - INTERVAL 7 DAY",
+                      "SELECT COUNT(*) AS total FROM sales WHERE sale_date = current_date",
+                      "SELECT NOW() AS total"):
+        assert 0 < cached_ttl(sql_query) <= app.CLOCK_RESULT_CACHE_TTL, sql_query
+
+def test_random_queries_are_not_cached():
+    assert cached_ttl("SELECT name AS total FROM products ORDER BY RAND() LIMIT 1") == -2
+
+def test_other_queries_keep_the_full_ttl():
+    assert cached_ttl("SELECT SUM(quantity) AS total FROM sales WHERE sale_date >= '2024-01-01'") > app.CLOCK_RESULT_CACHE_TTL
+
+if __name__ == "__main__":
+    test_clock_queries_are_cached_briefly()
+    test_random_queries_are_not_cached()
+    test_other_queries_keep_the_full_ttl()
+    print("Result-cache TTLs follow the query's dependence on the clock.")
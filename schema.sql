@@ -35,6 +35,9 @@ CREATE TABLE sales (
     FOREIGN KEY (product_id) REFERENCES products(id)
 );
 
+-- Date-range questions and incremental rollup refreshes filter sales by day
+CREATE INDEX idx_sales_sale_date ON sales (sale_date);
+
 -- Insert sample data into customers
 INSERT INTO customers (name, signup_date) VALUES
 ('Alice Johnson', '2023-01-15'),
@@ -0,0 +1,86 @@
+import fakeredis
+
+import app
+
+# Each pair: an answered question, then a new one. The new question must reuse the
+# answered question's cached SQL only when both ask the same thing.
+SAME_QUESTION = [
+    ("Top 5 products by sales?", "show me the top five products by sales"),
+    ("How many sales did we have last month?", "how many sales in the previous month"),
+    ("total revenue of products in each category", "the total revenue of products in each categories"),
+    ("total revenue per month", "monthly total revenue"),
+    ("which customers bought the most", "customers bought the most please"),
+]
+DIFFERENT_QUESTION = [
+    ("top products in May", "top products in March"),
+    ("June", "March"),
+    ("sales on Monday", "sales on Tuesday"),
+    ("sales for Alice Johnson", "sales for Alicia Johnson"),
+    ("orders from customer Smith", "orders from customer Smyth"),
+    ("customers who spent more than 100", "customers who spent more than 1000"),
+    ("products in the 'Electronics' category", "products in the 'Electrical' category"),
+    ("top 5 products by revenue", "bottom 5 products by revenue"),
+    ("products with price > 100", "products with price < 100"),
+    ("products with price > 100", "products with price = 100"),
+    ("products with price >= 100", "products with price > 100"),
+    ("products with price <= 100", "products with price != 100"),
+    ("products priced under 1.5", "products priced under 15"),
+    ("top 5 products with more than 10 sales", "top 10 products with more than 5 sales"),
+    ("sales from 2023 to 2024", "sales from 2024 to 2023"),
+    ("products priced above 100 and below 500", "products priced above 500 and below 100"),
+    ("customers who bought product 3 but not product 4", "customers who bought product 4 but not product 3"),
+    ("customers who bought Laptop but not Mouse", "customers who bought Mouse but not Laptop"),
+]
+
+def match(answered, asked):
+    app.question_index = app.QuestionIndex()
+    app.question_index.add(app.canonicalize_question(answered))
+    return app.match_cache_question(asked) == app.canonicalize_question(answered)
+
+def test_paraphrases_share_cached_sql():
+    for answered, asked in SAME_QUESTION:
+        assert match(answered, asked), f"should match: {asked!r} -> {answered!r}"
+
+def test_different_questions_do_not_share_cached_sql():
+    for answered, asked in DIFFERENT_QUESTION:
+        assert not match(answered, asked), f"should not match: {asked!r} -> {answered!r}"
+
+def test_index_keeps_the_most_recent_questions():
+    original_max, app.SIMILARITY_INDEX_MAX = app.SIMILARITY_INDEX_MAX, 3
+    app.redis_client = fakeredis.FakeRedis(decode_responses=True)
+    try:
+        app.question_index = app.QuestionIndex()
+        for number in range(5):
+            app.remember_question(f"sales of product {number}")
+        assert list(app.question_index.added) == [f"sales of product {number}" for number in (2, 3, 4)]
+        assert app.redis_client.zrange(app.SIMILARITY_INDEX_KEY, 0, -1) == [f"sales of product {number}" for number in (2, 3, 4)]
+
+        # Another worker picks them up, without the questions whose SQL has expired.
+        app.redis_client.zadd(app.SIMILARITY_INDEX_KEY, {"sales of product 1": 1000.0})
+        app.question_index = app.QuestionIndex()
+        app.sync_question_index()
+        assert sorted(app.question_index.vectors) == [f"sales of product {number}" for number in (2, 3, 4)]
+        app.question_index.expire(app.question_index.added["sales of product 3"])
+        assert list(app.question_index.added) == ["sales of product 3", "sales of product 4"]
+    finally:
+        app.SIMILARITY_INDEX_MAX = original_max
+
+def test_rate_limited_requests_skip_similarity():
+    def find_cache_question(user_question):
+        raise AssertionError("near-duplicate matching ran for a rate-limited request")
+    original_find, original_limit = app.find_cache_question, app.RATE_LIMITS['minute']['limit']
+    app.redis_client = fakeredis.FakeRedis(decode_responses=True)
+    app.find_cache_question, app.RATE_LIMITS['minute']['limit'] = find_cache_question, 0
+    try:
+        client = app.app.test_client()
+        assert client.post("/query", json={"question": "top products in May"}).status_code == 429
+        assert client.post("/query/batch", json={"questions": ["top products in May"]}).status_code == 429
+    finally:
+        app.find_cache_question, app.RATE_LIMITS['minute']['limit'] = original_find, original_limit
+
+if __name__ == "__main__":
+    test_paraphrases_share_cached_sql()
+    test_different_questions_do_not_share_cached_sql()
+    test_index_keeps_the_most_recent_questions()
+    test_rate_limited_requests_skip_similarity()
+    print("Near-duplicate matching accepts paraphrases and rejects different questions.")